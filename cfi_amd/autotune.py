@@ -0,0 +1,157 @@
+"""
+Autotune of the runner configuration: worker processes x torch threads x batch size.
+
+Runs cfi_amd.main on a few sample images for each configuration (each in a new process),
+and selects the configuration with the most images per second within a memory budget.
+The selection is saved as the machine profile (see utils.machine_profile), which cfi_amd.main
+applies to the arguments that are not set.
+
+Usage:
+python -m cfi_amd.autotune --csv_path input.csv --n_images 16 --workers 1 2 4 8 --torch_threads 1 2 4 8
+Other arguments are passed to cfi_amd.main (e.g. --measure_in_model_space, --mask_format npz),
+except the result and preprocessing caches.
+"""
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import tempfile
+import pandas as pd
+
+from .main import main, get_parser, get_device
+from .utils.machine_profile import default_profile_path, save_profile
+
+
+def get_total_memory():
+    # physical memory in bytes (None if not available)
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def powers_of_two(maximum):
+    return [2 ** i for i in range(maximum.bit_length()) if 2 ** i <= maximum]
+
+
+def run_configuration(main_args, queue):
+    # runs in a new process, so the peak memory is of this configuration only
+    args = get_parser().parse_args(main_args)
+    stats = main(args.csv_path, args.output_folder, args)
+    queue.put(stats.to_dict())
+
+
+def benchmark(main_args):
+    '''
+    Returns:
+    - RunStats.to_dict() of the run, or None if the run failed (e.g. killed when out of memory)
+    '''
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_configuration, args=(main_args, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0 or queue.empty():
+        return None
+    return queue.get()
+
+
+def autotune(csv_path, n_images, workers, torch_threads, batch_sizes, memory_budget,
+             profile_path=None, main_args=()):
+    '''
+    Returns:
+    - profile (dict), None if no configuration succeeded within the memory budget
+    '''
+    import torch
+    cpu_count = os.cpu_count()
+    configurations = [
+        (w, t, b) for w, t, b in itertools.product(workers, torch_threads, batch_sizes)
+        if w * t <= cpu_count
+    ]
+    sample = pd.read_csv(csv_path).head(n_images)
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for w, t, b in configurations:
+            # enough batches for each worker, throughput is measured after the first batch of each worker
+            n_rows = max(n_images, 4 * w * b)
+            rows = pd.concat([sample] * (n_rows // len(sample) + 1)).head(n_rows)
+            # unique identifiers, so the outputs are written as in a real run
+            rows = rows.assign(identifier=[f'{i}_{identifier}' for i, identifier in enumerate(rows.identifier)])
+            rows.to_csv(f'{folder}/input.csv', index=False)
+
+            print(f'Benchmarking workers={w}, torch_threads={t}, batch_size={b}')
+            stats = benchmark([
+                *main_args,
+                '--csv_path', f'{folder}/input.csv',
+                '--output_folder', f'{folder}/output_{w}_{t}_{b}',
+                '--workers', str(w), '--torch_threads', str(t), '--batch_size', str(b),
+                '--profile', 'none',
+            ])
+            if stats is None or stats['images_per_second'] is None:
+                print('  failed')
+                continue
+            print(f"  {stats['images_per_second']:.3f} images/s, "
+                  f"peak memory {stats['peak_memory'] / 1024**3:.1f} GB")
+            results.append({'workers': w, 'torch_threads': t, 'batch_size': b, **stats})
+
+    valid = [
+        r for r in results
+        if memory_budget is None or r['peak_memory'] <= memory_budget
+    ]
+    if not valid:
+        print('No configuration succeeded within the memory budget')
+        return None
+    best = max(valid, key=lambda r: r['images_per_second'])
+
+    profile = {
+        'workers': best['workers'],
+        'torch_threads': best['torch_threads'],
+        'batch_size': best['batch_size'],
+        'images_per_second': best['images_per_second'],
+        'peak_memory': best['peak_memory'],
+        'memory_budget': memory_budget,
+        'cpu_count': cpu_count,
+        'device': get_device().type,
+        'torch_version': torch.__version__,
+        'results': results,
+    }
+    save_profile(profile, profile_path)
+    print(f"Selected workers={best['workers']}, torch_threads={best['torch_threads']}, "
+          f"batch_size={best['batch_size']}, saved to {profile_path or default_profile_path()}")
+    return profile
+
+
+if __name__ == "__main__":
+    cpu_count = os.cpu_count()
+    parser = argparse.ArgumentParser(
+        description='Benchmark worker processes x torch threads x batch size and save a machine profile.')
+    parser.add_argument('--csv_path', type=str, default='/input.csv',
+                        help='CSV file with sample images (the first n_images are used)')
+    parser.add_argument('--n_images', type=int, default=16,
+                        help='Number of sample images')
+    parser.add_argument('--workers', type=int, nargs='+', default=powers_of_two(cpu_count),
+                        help='Numbers of worker processes to try')
+    parser.add_argument('--torch_threads', type=int, nargs='+', default=powers_of_two(cpu_count),
+                        help='Numbers of torch threads per worker to try (workers x threads <= number of cpus)')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2, 4],
+                        help='Batch sizes to try')
+    parser.add_argument('--memory_budget_gb', type=float, default=None,
+                        help='Maximum peak memory of a run (default: 80%% of the physical memory)')
+    parser.add_argument('--profile_path', type=str, default=None,
+                        help='Where to save the profile (default: profile.json in the user cache directory)')
+
+    args, main_args = parser.parse_known_args()
+    # the sample images are repeated, cached results would be re-used
+    for cache_arg in '--result_cache_dir', '--preprocess_cache_dir':
+        if any(a.startswith(cache_arg) for a in main_args):
+            parser.error(f'{cache_arg} can not be used for autotune')
+    if args.memory_budget_gb is not None:
+        memory_budget = args.memory_budget_gb * 1024**3
+    else:
+        total_memory = get_total_memory()
+        memory_budget = 0.8 * total_memory if total_memory else None
+
+    autotune(args.csv_path, args.n_images, args.workers, args.torch_threads, args.batch_sizes,
+             memory_budget, args.profile_path, main_args)
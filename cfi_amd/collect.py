@@ -0,0 +1,286 @@
+"""
+Collects the results of existing output folders (report.json, bounds.json and coordinates.json
+of each identifier) into results_full.csv and results_area.csv (same layout as cfi_amd.main),
+or results_full.parquet and results_area.parquet.
+
+The sidecar files are read with a thread pool (fast on network storage), identifiers without
+report.json are listed in missing.csv. Images that failed the gradability gate of cfi_amd.main
+(gradability.json without report.json) are not missing, with --gradability the reasons are
+added to the tables.
+With --incremental, the rows of the previous run are kept in collect_cache.jsonl and only
+folders with changed files are read again.
+
+Usage:
+python -m cfi_amd.collect --csv_path input.csv --output_folder /output --workers 32 --incremental
+"""
+
+import csv
+import json
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from .main import feature_names
+from .utils.cfi_bounds import CFIBounds
+
+sidecar_names = 'report.json', 'bounds.json', 'coordinates.json', 'gradability.json'
+area_keys = 'total_area', 'grid_area', 'outer_area', 'inner_area', 'center_area'
+coords_header = ['disc_edge_x', 'disc_edge_y', 'fovea_x', 'fovea_y']
+
+
+def get_signature(folder):
+    # modification times and sizes of the sidecar files (None if missing)
+    signature = []
+    for name in sidecar_names:
+        try:
+            stat = os.stat(f'{folder}/{name}')
+            signature.append([stat.st_mtime_ns, stat.st_size])
+        except FileNotFoundError:
+            signature.append(None)
+    return signature
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def bounds_to_list(bounds):
+    # same as CFIBounds.to_list, from the dict in bounds.json
+    result = [*bounds['center'], bounds['radius']]
+    for line in ['top', 'bottom', 'left', 'right']:
+        if line in bounds['lines']:
+            (x0, y0), (x1, y1) = bounds['lines'][line]
+            result.extend([x0, y0, x1, y1])
+        else:
+            result.extend([None, None, None, None])
+    return result
+
+
+def read_results(folder):
+    '''
+    Returns:
+    - dict with the summaries ('report'), bounds as list ('bounds'), coordinates as list ('coords')
+    and the gradability reasons ('gradability'), None for missing files.
+    None if both report.json and gradability.json are missing.
+    '''
+    report = read_json(f'{folder}/report.json')
+    quality = read_json(f'{folder}/gradability.json')
+    if report is None and quality is None:
+        return None
+    bounds = read_json(f'{folder}/bounds.json')
+    coords = read_json(f'{folder}/coordinates.json')
+    return {
+        'report': report,
+        'bounds': None if bounds is None else bounds_to_list(bounds),
+        'coords': None if coords is None else [*coords['disc_edge'], *coords['fovea']],
+        # same as the gradability column of cfi_amd.main
+        'gradability': None if quality is None else ';'.join(quality['reasons']) or 'ok',
+    }
+
+
+class Collector:
+    '''
+    Reads the results of the output folders of identifiers, re-using the results of
+    a previous run (cache) for folders with unchanged files.
+    '''
+
+    def __init__(self, output_folder, workers=16, cache=None):
+        self.output_folder = output_folder
+        self.workers = workers
+        self.cache = cache or {}
+        self.new_cache = {}
+
+    def read(self, identifier):
+        '''
+        Returns:
+        - results (see read_results) and whether they were taken from the cache
+        '''
+        folder = f'{self.output_folder}/{identifier}'
+        signature = get_signature(folder)
+        cached = self.cache.get(identifier)
+        if cached is not None and cached[0] == signature:
+            self.new_cache[identifier] = cached
+            return cached[1], True
+        if signature[0] is None and signature[3] is None:
+            return None, False
+        try:
+            results = read_results(folder)
+        except Exception as e:
+            print(f'Error reading results of {identifier}: {e}')
+            return None, False
+        self.new_cache[identifier] = signature, results
+        return results, False
+
+    def iter_results(self, identifiers, chunk_size=4096):
+        # in the order of identifiers, chunked to bound the number of pending reads
+        with ThreadPoolExecutor(self.workers) as executor:
+            for start in range(0, len(identifiers), chunk_size):
+                yield from executor.map(self.read, identifiers[start:start + chunk_size])
+
+
+def load_cache(path):
+    cache = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                identifier, signature, results = json.loads(line)
+                cache[identifier] = signature, results
+    return cache
+
+
+def save_cache(path, cache):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        for identifier, (signature, results) in cache.items():
+            f.write(json.dumps([identifier, signature, results]) + '\n')
+    os.replace(tmp_path, path)
+
+
+class TableWriter:
+    '''
+    Writes rows of results_full and results_area, streaming to csv files or collected for parquet.
+    The summary columns are taken from the first row with a report, rows before it are buffered.
+    '''
+
+    def __init__(self, results_folder, format='csv', gradability=False):
+        self.results_folder = results_folder
+        self.format = format
+        self.gradability = gradability
+        self.keys = None
+        self.pending = []
+        self.files = []
+        self.tables = {'full': [], 'area': []}
+
+    def headers(self):
+        summary_full = [f'{f}_{k}' for f in feature_names for k in self.keys]
+        summary_area = [f'{f}_{k}' for f in feature_names for k in area_keys]
+        gradability = ['gradability'] if self.gradability else []
+        return {
+            'full': ['identifier', 'path'] + summary_full + CFIBounds.list_names + coords_header + gradability,
+            'area': ['identifier', 'path'] + summary_area + gradability,
+        }
+
+    def start(self):
+        if self.format == 'csv':
+            self.writers = {}
+            for name, header in self.headers().items():
+                f = open(f'{self.results_folder}/results_{name}.csv', 'w', newline='')
+                self.files.append(f)
+                # same line endings as the pandas tables of cfi_amd.main
+                self.writers[name] = csv.writer(f, lineterminator='\n')
+                self.writers[name].writerow(header)
+        for row in self.pending:
+            self.write_row(*row)
+        self.pending = None
+
+    def add(self, row, results):
+        if self.keys is None:
+            if results is None or results['report'] is None:
+                self.pending.append((row, results))
+                return
+            self.keys = list(results['report'][feature_names[0]].keys())
+            self.start()
+        self.write_row(row, results)
+
+    def write_row(self, row, results):
+        identifier, path = row
+        results = results or {}
+        report = results.get('report')
+        if report is None:
+            full = [None] * (len(feature_names) * len(self.keys))
+            area = [None] * (len(feature_names) * len(area_keys))
+        else:
+            full = [report[f].get(k) for f in feature_names for k in self.keys]
+            area = [report[f].get(k) for f in feature_names for k in area_keys]
+        full += results.get('bounds') or [None] * len(CFIBounds.list_names)
+        full += results.get('coords') or [None] * len(coords_header)
+        if self.gradability:
+            full.append(results.get('gradability'))
+            area.append(results.get('gradability'))
+
+        rows = {'full': [identifier, path] + full, 'area': [identifier, path] + area}
+        for name, values in rows.items():
+            if self.format == 'csv':
+                self.writers[name].writerow(values)
+            else:
+                self.tables[name].append(values)
+
+    def close(self):
+        if self.keys is None:
+            print('No results were found')
+            return
+        for f in self.files:
+            f.close()
+        if self.format == 'parquet':
+            import pandas as pd
+            for name, header in self.headers().items():
+                df = pd.DataFrame(self.tables[name], columns=header)
+                df.to_parquet(f'{self.results_folder}/results_{name}.parquet', index=False)
+
+
+def collect(csv_path, output_folder, results_folder=None, format='csv', workers=16, incremental=False,
+            gradability=False):
+    '''
+    Writes results_full and results_area for all identifiers in csv_path to results_folder
+    (default: output_folder) and missing.csv with the identifiers without results.
+    gradability: add the gradability column (for runs with --gradability_gate)
+
+    Returns:
+    - list of missing identifiers
+    '''
+    results_folder = results_folder or output_folder
+    os.makedirs(results_folder, exist_ok=True)
+    cache_path = f'{results_folder}/collect_cache.jsonl'
+
+    # read as in cfi_amd.main (e.g. the identifier 0001 is the folder 1), pandas is only needed here
+    import pandas as pd
+    df = pd.read_csv(csv_path)
+    rows = [(str(row.identifier), str(row.path)) for _, row in df.iterrows()]
+
+    collector = Collector(output_folder, workers, load_cache(cache_path) if incremental else None)
+    writer = TableWriter(results_folder, format, gradability)
+    missing = []
+    n_cached = 0
+    for row, (results, cached) in zip(rows, collector.iter_results([i for i, _ in rows])):
+        writer.add(row, results)
+        if results is None:
+            missing.append(row)
+        n_cached += cached
+    writer.close()
+
+    with open(f'{results_folder}/missing.csv', 'w', newline='') as f:
+        csv.writer(f, lineterminator='\n').writerows([('identifier', 'path'), *missing])
+
+    if incremental:
+        save_cache(cache_path, collector.new_cache)
+    print(f'Collected {len(rows) - len(missing)}/{len(rows)} identifiers '
+          f'({n_cached} unchanged), {len(missing)} missing (see missing.csv)')
+    return [identifier for identifier, _ in missing]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Collect the results of existing output folders into result tables.')
+    parser.add_argument('--csv_path', type=str,
+                        help='Path to the CSV file with the identifiers.', default='/input.csv')
+    parser.add_argument('--output_folder', type=str,
+                        help='Folder with the inference results (a subfolder for each identifier).',
+                        default='/output')
+    parser.add_argument('--results_folder', type=str, default=None,
+                        help='Folder to write the tables to (default: output_folder)')
+    parser.add_argument('--format', type=str, choices=['csv', 'parquet'], default='csv',
+                        help='Format of the tables (parquet requires pyarrow)')
+    parser.add_argument('--workers', type=int, default=16,
+                        help='Number of threads reading the output folders')
+    parser.add_argument('--incremental', action=argparse.BooleanOptionalAction, default=False,
+                        help='Only read folders changed since the last run (cached in collect_cache.jsonl)')
+    parser.add_argument('--gradability', action=argparse.BooleanOptionalAction, default=False,
+                        help='Add the gradability column (gradability.json of runs with --gradability_gate)')
+
+    args = parser.parse_args()
+    collect(args.csv_path, args.output_folder, args.results_folder,
+            args.format, args.workers, args.incremental, args.gradability)
@@ -0,0 +1,102 @@
+"""
+Combination of the model outputs, without torch (used by the Processor, cfi_amd.recombine and the result cache).
+
+Classes:
+- ProcessResult
+"""
+
+import numpy as np
+from collections.abc import Mapping
+
+# optimal thresholds for each model
+# based on average dice score on validation images with reference segmentation
+thresholds = {
+    'drusen': (0.81, 0.76, 0.44, 0.72, 0.58),
+    'rpe_degeneration': (0.53, 0.8, 0.75, 0.74, 0.09),
+    'hyperpigmentation': (0.44, 0.47, 0.65, 0.22, 0.28),
+    'RPD': (0.19, 0.11, 0.08, 0.07, 0.39),
+}
+# optimal thresholds for each model
+# based on single dice score on full validation set
+thresholds_global = {
+    'drusen': (0.85, 0.74, 0.47, 0.66, 0.69),
+    'rpe_degeneration': (0.75, 0.76, 0.45, 0.65, 0.60),
+    'hyperpigmentation': (0.59, 0.92, 0.74, 0.78, 0.37),
+    'RPD': (0.85, 0.34, 0.78, 0.72, 0.70)
+}
+
+
+def combine_ensemble(y_preds, thresholds, mode="th_0.5"):
+    '''
+    y_preds: array (n_models, h, w) with the sigmoid output of each model
+    thresholds: optimal threshold of each model (used for mode "th_optimal")
+    '''
+    if mode == "th_0.5":
+        return np.mean(y_preds, axis=0)
+    elif mode == "th_optimal":
+        result = np.zeros_like(y_preds[0])
+        for th, y_pred in zip(thresholds, y_preds):
+            result += y_pred ** (np.log(th) / np.log(0.5))
+        return result / len(y_preds)
+    raise ValueError(f'Unknown mode: {mode}')
+
+
+def combine_folds(folds, thresholds, mode="th_0.5"):
+    '''
+    folds: dict with the stacked model outputs of each feature (see Processor.predict_folds)
+    Returns:
+    - dict with the ensemble output of each feature
+    '''
+    return {
+        feature: combine_ensemble(y_preds, thresholds[feature], mode)
+        for feature, y_preds in folds.items()
+    }
+
+
+class ProcessResult(Mapping):
+    '''
+    Output of Processor.process, can be used as a dict with keys 'bounds' and the feature names
+
+    The ensemble output of each feature is stored in model space (the 1024 x 1024 crop of the bounds),
+    optionally quantised to uint8. result[feature] warps it to a full size probability map
+    (zero outside the bounds). This is computed on each access, store the result to reuse it.
+    '''
+
+    def __init__(self, bounds, transform, maps, quantize=False, folds=None):
+        '''
+        bounds: CFIBounds of the original image
+        transform: ProjectiveTransform from the original image to model space
+        maps: dict with the model space output for each feature
+        quantize: store maps as uint8
+        folds: optional dict with the model space output of each model (see Processor.predict_folds)
+        '''
+        self.bounds = bounds
+        self.transform = transform
+        self.folds = folds
+        self.quantized = quantize
+        if quantize:
+            maps = {
+                feature: np.round(np.clip(y, 0, 1) * 255).astype(np.uint8)
+                for feature, y in maps.items()
+            }
+        self.maps = maps
+
+    def get_model_space(self, feature):
+        y = self.maps[feature]
+        if self.quantized:
+            return y.astype(np.float32) / 255
+        return y
+
+    def __getitem__(self, key):
+        if key == 'bounds':
+            return self.bounds
+        y_orig = self.transform.warp_inverse(self.get_model_space(key))
+        y_orig[~self.bounds.mask] = 0
+        return y_orig
+
+    def __iter__(self):
+        yield 'bounds'
+        yield from self.maps
+
+    def __len__(self):
+        return 1 + len(self.maps)
@@ -0,0 +1,77 @@
+"""
+Import time of the command line modules, guards the fast start of short jobs and --help.
+
+Each module is imported in a new interpreter (python -X importtime). The command fails (exit code 1)
+if a module imports one of its excluded dependencies, or if the import takes longer than --max_seconds.
+Heavy dependencies are imported by the functions that need them (e.g. torch and the models when
+a run starts), Lightning is not needed for inference.
+
+Usage:
+python -m cfi_amd.import_benchmark --max_seconds 1
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+heavy_dependencies = 'torch', 'lightning', 'pandas', 'sklearn', 'scipy', 'pydicom'
+
+# module -> dependencies it must not import
+modules = {
+    'cfi_amd.main': heavy_dependencies,
+    'cfi_amd.collect': heavy_dependencies,
+    # pandas reads the csv of the rows to recombine
+    'cfi_amd.recombine': ('torch', 'lightning', 'sklearn', 'pydicom'),
+    'cfi_amd.autotune': ('torch', 'lightning', 'sklearn', 'pydicom'),
+}
+
+
+def measure_import(module):
+    '''
+    Returns:
+    - import time of module in seconds (cumulative, as reported by -X importtime)
+    - top level packages imported by module
+    '''
+    code = f'import sys, json; before = set(sys.modules); import {module}; print(json.dumps(sorted(set(sys.modules) - before)))'
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             capture_output=True, text=True, check=True)
+    seconds = None
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split('|')
+        if line.startswith('import time:') and len(parts) == 3 and parts[2].strip() == module:
+            seconds = int(parts[1]) / 1e6
+    imported = {name.split('.')[0] for name in json.loads(process.stdout.splitlines()[-1])}
+    return seconds, imported
+
+
+def benchmark(max_seconds=None, repeat=3):
+    '''
+    Returns:
+    - True if all modules pass
+    '''
+    passed = True
+    for module, excluded in modules.items():
+        results = [measure_import(module) for _ in range(repeat)]
+        seconds = min(s for s, _ in results)
+        imported = sorted(set(excluded) & results[0][1])
+        ok = not imported and (max_seconds is None or seconds <= max_seconds)
+        passed &= ok
+        print(f"{module}: {seconds:.3f} s{'' if ok else '  FAILED'}")
+        if imported:
+            print(f"  imports {', '.join(imported)}")
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Measure the import time of the command line modules and check that they '
+        'do not import heavy dependencies.')
+    parser.add_argument('--max_seconds', type=float, default=None,
+                        help='Maximum import time of each module')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of measurements of each module (the fastest is reported)')
+    args = parser.parse_args()
+
+    sys.exit(0 if benchmark(args.max_seconds, args.repeat) else 1)
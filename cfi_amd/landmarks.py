@@ -1,16 +1,80 @@
+import os
+from typing import List
 import torch
 import numpy as np
 from .utils.mask_extraction import get_cfi_bounds
+from .utils.transformation import apply_inverse_batch
+from .utils.shared_weights import SharedWeights
+from .resources import get_models_base_dir, ensure_models_downloaded
 
+# relative to the models folder (see resources)
 paths = {
-    "disc_edge": "models/discedge_july24.pt",
-    "fovea": "models/fovea_july24.pt"
+    "disc_edge": "discedge_july24.pt",
+    "fovea": "fovea_july24.pt"
 }
 
-def preprocess(image, bounds=None):
-    mean = np.array([0.485, 0.456, 0.406] * 2)
-    std = np.array([0.229, 0.224, 0.225] * 2)
 
+def load_model(name, device, models_dir=None, optimize=True):
+    '''
+    Loads a landmark model (TorchScript) from the models folder.
+    With optimize, the model is frozen (torch.jit.freeze) and optimised for inference
+    (torch.jit.optimize_for_inference). Freezing is done once, the frozen model is stored in the models folder
+    under frozen/torch_{version}/{device type}/. The optimisation is fast and done on each load:
+    optimised graphs can not be loaded again with all torch versions.
+    '''
+    base_dir = get_models_base_dir(models_dir)
+    ensure_models_downloaded(base_dir)
+    path = base_dir / paths[name]
+    device = torch.device(device)
+    if not optimize:
+        return torch.jit.load(str(path), map_location=device).eval()
+
+    frozen_path = base_dir / 'frozen' / f'torch_{torch.__version__}' / device.type / paths[name]
+    model = None
+    if frozen_path.exists():
+        try:
+            model = torch.jit.load(str(frozen_path), map_location=device)
+        except RuntimeError as e:
+            print(f'Error loading frozen model {frozen_path}, freezing again: {e}')
+
+    if model is None:
+        print(f"freezing model: {path}")
+        model = torch.jit.load(str(path), map_location=device).eval()
+        try:
+            model = torch.jit.freeze(model)
+        except Exception as e:
+            print(f'Error freezing model {path}, using the original model: {e}')
+            return model
+        save_frozen(model, frozen_path)
+
+    try:
+        return torch.jit.optimize_for_inference(model)
+    except Exception as e:
+        print(f'Error optimizing model {path}, using the frozen model: {e}')
+        return model
+
+
+def save_frozen(model, frozen_path):
+    # other processes may be writing the same file
+    tmp_path = frozen_path.with_name(f'{frozen_path.name}.{os.getpid()}.tmp')
+    try:
+        frozen_path.parent.mkdir(parents=True, exist_ok=True)
+        torch.jit.save(model, str(tmp_path))
+        tmp_path.replace(frozen_path)
+    except OSError as e:
+        # e.g. read-only models folder, frozen again on the next run
+        print(f'Error saving frozen model {frozen_path}: {e}')
+
+mean = np.array([0.485, 0.456, 0.406] * 2)
+std = np.array([0.229, 0.224, 0.225] * 2)
+
+
+def get_input(image, bounds=None):
+    '''
+    Returns:
+    - T: cropping transform
+    - uint8 input (512, 512, 6): the cropped image and contrast enhanced image
+    '''
     if bounds is None:
         bounds = get_cfi_bounds(image)
     T, bounds_cropped = bounds.crop(512)
@@ -18,7 +82,18 @@ def preprocess(image, bounds=None):
     images = np.concatenate([
         bounds_cropped.image,
         bounds_cropped.contrast_enhanced_5], axis=2)
+    return T, images
+
+
+def normalize(x):
+    # x: uint8 tensor (N, H, W, C), computed in float64 as in preprocess
+    mean_t = torch.tensor(mean, device=x.device)
+    std_t = torch.tensor(std, device=x.device)
+    return ((x.double() - mean_t) / std_t).permute(0, 3, 1, 2).float().contiguous()
+
 
+def preprocess(image, bounds=None):
+    T, images = get_input(image, bounds)
     images_norm = (images - mean) / std
 
     return T, np.transpose(images_norm, (2, 0, 1)).astype(np.float32)
@@ -29,25 +104,142 @@ def get_coordinate(heatmap):
     return x + 0.5, y + 0.5
 
 
+def get_coordinates(heatmaps):
+    '''
+    get_coordinate for a tensor of heatmaps (..., H, W), computed on the device of heatmaps
+
+    Returns:
+    - tensor (..., 2) with the x, y coordinates
+    '''
+    w = heatmaps.shape[-1]
+    # first maximum in row-major order, same as np.argmax
+    index = torch.argmax(heatmaps.flatten(-2), dim=-1)
+    return torch.stack([index % w, index // w], dim=-1).double() + 0.5
+
+
+class ForkedModels(torch.nn.Module):
+    '''
+    Runs the models concurrently on the same input. Scripted (torch.jit.script), torch.jit.fork starts
+    each model as a task on the inter-op thread pool (in eager mode fork would run them one after the other).
+    '''
+
+    def __init__(self, models):
+        super().__init__()
+        self.models = torch.nn.ModuleList(models)
+
+    def forward(self, x: torch.Tensor) -> List[torch.Tensor]:
+        futures = torch.jit.annotate(List[torch.jit.Future[torch.Tensor]], [])
+        for model in self.models:
+            futures.append(torch.jit.fork(model, x))
+        return [torch.jit.wait(future) for future in futures]
+
+
+def fork_models(models):
+    '''
+    Returns:
+    - function of the input, returning the outputs of models (in order), concurrently if the models can be scripted
+    '''
+    try:
+        return torch.jit.script(ForkedModels(models))
+    except Exception as e:
+        print(f'Error scripting the landmark models, running them one after the other: {e}')
+        return lambda x: [model(x) for model in models]
+
+
 class LandmarksProcessor:
     
-    def __init__(self, device):
+    def __init__(self, device, preprocess_cache=None, models_dir=None, optimize=True, weights=None):
+        '''
+        preprocess_cache: optional utils.preprocess_cache.PreprocessCache for the model inputs
+        models_dir: optional path to the folder containing the models
+        optimize: use frozen, inference optimised models (see load_model)
+        weights: optional utils.shared_weights.SharedWeights made by share_weights in another process.
+        Frozen models have no weights to share, so the models are not optimised.
+        '''
         self.device = device
-        self.models = {
-            k: torch.jit.load(v).eval()
-            for k, v in paths.items()
-        }
-        for model in self.models.values():
-            model.to(device)
+        self.preprocess_cache = preprocess_cache
+        if weights is not None:
+            self.models = {
+                k: weights.attach(k, load_model(k, device, models_dir, optimize=False))
+                for k in paths
+            }
+        else:
+            self.models = {
+                k: load_model(k, device, models_dir, optimize)
+                for k in paths
+            }
+        # the models share their weights with self.models
+        self.run_models = fork_models(list(self.models.values()))
+
+    def share_weights(self):
+        '''
+        Copies the weights of the models (on CPU, not optimised) to shared memory,
+        for LandmarksProcessors in worker processes
+
+        Returns:
+        - utils.shared_weights.SharedWeights
+        '''
+        return SharedWeights(self.models)
+
+    def get_input(self, image, bounds=None, image_hash=None):
+        # get_input, loaded from / saved to self.preprocess_cache if set
+        # image_hash: optional utils.utils.get_image_hash of the image (for the cache key)
+        cache = self.preprocess_cache
+        if cache is None:
+            return get_input(image, bounds)
+        key = cache.get_key(image, image_hash)
+        cached = cache.load(image, 512, key)
+        if cached is not None:
+            _, T, x = cached
+            return T, x
+        if bounds is None:
+            bounds = get_cfi_bounds(image)
+        T, x = get_input(image, bounds)
+        cache.save(image, 512, bounds, T, x, key)
+        return T, x
 
     def process(self, image, bounds=None):
-        T, x_np = preprocess(image, bounds)
-        x_torch = torch.tensor(x_np).unsqueeze(0).to(self.device)
-
-        coordinates = {}
-        for name, model in self.models.items():
-            heatmaps = model(x_torch)
-            heatmap = torch.mean(heatmaps, dim=0)[0, 0]
-            p = get_coordinate(heatmap.cpu().detach().numpy())
-            coordinates[name] = T.apply_inverse([p])[0]
-        return coordinates
+        return self.process_batch([image], [bounds])[0]
+
+    def process_batch(self, images, bounds=None, image_hashes=None):
+        '''
+        Landmarks for a list of images, running each model once on the stacked inputs
+
+        Args:
+        - images: list of images
+        - bounds: optional list of CFIBounds (one for each image)
+        - image_hashes: optional list of image hashes (see get_input)
+
+        Returns:
+        - list of coordinates (one dict for each image)
+        '''
+        if bounds is None:
+            bounds = [None] * len(images)
+        if image_hashes is None:
+            image_hashes = [None] * len(images)
+        transforms, xs = zip(*(
+            self.get_input(image, b, h) for image, b, h in zip(images, bounds, image_hashes)
+        ))
+        # normalised on the device, the uint8 input is 4 times smaller to transfer
+        x_torch = normalize(torch.from_numpy(np.stack(xs)).to(self.device))
+
+        # release the cached 512 crops (and contrast enhanced images)
+        for b in bounds:
+            if b is not None:
+                b.release_crop(512)
+
+        with torch.no_grad():
+            # the models run concurrently (see ForkedModels)
+            outputs = self.run_models(x_torch)
+            # mean over the ensemble (first dimension), first channel
+            heatmaps = torch.stack([
+                torch.mean(y, dim=0)[:, 0] for y in outputs
+            ], dim=1)
+            # only the coordinates are copied from the device: (N, n_models, 2)
+            points = get_coordinates(heatmaps).cpu().numpy()
+
+        points = apply_inverse_batch(transforms, points)
+        return [
+            {name: p for name, p in zip(self.models, image_points)}
+            for image_points in points
+        ]
@@ -1,32 +1,82 @@
-import pandas as pd
-import torch
 from PIL import Image
 import numpy as np
 import os
 import json
-from .utils.utils import open_image, to_uint8
-from .utils.report import Report
+import argparse
+import multiprocessing
+# pandas, torch and the models are imported by the functions that need them, for a fast start
+from .utils.utils import open_image, to_uint8, get_image_hash
+from .utils.report import Report, export_style
+from .utils.packed_masks import save_masks, MaskStore
+from .utils.lesion_polygons import export_lesion_polygons
+from .utils.export_executor import ExportExecutor
+from .utils.fold_store import save_folds
+from .utils.preprocess_cache import PreprocessCache
+from .utils.run_stats import RunStats, get_peak_memory, get_device_peak_memory, reset_peak_memory
+from .utils.machine_profile import load_profile, apply_profile
+from .utils.cfi_bounds import CFIBounds
 from .utils.etdrs_masks import ETDRS_masks
-from .processor import Processor
-from .landmarks import LandmarksProcessor
+from .utils.mask_extraction import get_cfi_bounds_batch
+from .utils.gradability import check_gradability_batch
 
 feature_names = 'drusen', 'RPD', 'hyperpigmentation', 'rpe_degeneration'
 
 
-def get_processors():
+def get_device():
+    import torch
     if torch.cuda.is_available():
-        device = torch.device('cuda')
+        return torch.device('cuda')
     else:
-        device = torch.device('cpu')
-    return Processor(device), LandmarksProcessor(device)
-
-
-def export_features(result, base_path, export_probability, skip_empty=True):
+        return torch.device('cpu')
+
+
+def get_processors(preprocess_cache=None, weights=None, model_threads=1):
+    '''
+    weights: optional shared weights of the processors (see load_shared_weights)
+    model_threads: number of segmentation models run concurrently (see Processor)
+    '''
+    from .processor import Processor
+    from .landmarks import LandmarksProcessor
+    device = get_device()
+    processor_weights, landmarks_weights = weights or (None, None)
+    return (Processor(device, preprocess_cache=preprocess_cache, weights=processor_weights,
+                      model_threads=model_threads),
+            LandmarksProcessor(device, preprocess_cache, weights=landmarks_weights))
+
+
+def load_shared_weights():
+    '''
+    Loads the models once and copies their weights to shared memory, for the worker processes (CPU only)
+
+    Returns:
+    - SharedWeights of the Processor and the LandmarksProcessor
+    '''
+    from .processor import Processor
+    from .landmarks import LandmarksProcessor
+    device = get_device()
+    return (Processor(device).share_weights(),
+            LandmarksProcessor(device, optimize=False).share_weights())
+
+
+def get_preprocess_cache(args):
+    if args.preprocess_cache_dir is None:
+        return None
+    return PreprocessCache(args.preprocess_cache_dir)
+
+
+def export_features(result, base_path, export_probability, skip_empty=True, feature_images=None):
+    '''
+    feature_images: optional full size binary images of the features (see get_feature_images),
+    used for the binary masks instead of warping result again
+    '''
     for feature_name in feature_names:
         if export_probability:
             img = Image.fromarray(result[feature_name])
         else:
-            binary_image = result[feature_name] >= 0.5
+            if feature_images is not None:
+                binary_image = feature_images[feature_name]
+            else:
+                binary_image = result[feature_name] >= 0.5
             if skip_empty and not np.any(binary_image):
                 continue
             img = Image.fromarray(to_uint8(binary_image))
@@ -36,6 +86,24 @@ def export_features(result, base_path, export_probability, skip_empty=True):
         print(f'exported {feature_name} to {path}')
 
 
+def export_features_packed(result, base_path, export_probability, compression='deflate',
+                           mask_store=None, identifier=None, feature_images=None):
+    # all masks in one container, cropped to the bounds (see utils.packed_masks)
+    if feature_images is not None and not export_probability:
+        masks = {feature_name: feature_images[feature_name] for feature_name in feature_names}
+    else:
+        masks = {feature_name: result[feature_name] for feature_name in feature_names}
+    if mask_store is not None:
+        mask_store.append(identifier, masks, result['bounds'], export_probability, compression)
+        print(f'exported masks of {identifier} to {mask_store.folder}')
+        return
+
+    extension = 'npz.zst' if compression == 'zstd' else 'npz'
+    path = f'{base_path}/masks.{extension}'
+    save_masks(path, masks, result['bounds'], export_probability, compression)
+    print(f'exported masks to {path}')
+
+
 def get_resolution(fovea_x, fovea_y, disc_x, disc_y):
     # estimate the resolution of the image
 
@@ -49,7 +117,7 @@ def get_resolution(fovea_x, fovea_y, disc_x, disc_y):
     return resolution
 
 
-def get_etdrs_masks(bounds, coords):
+def get_etdrs_masks(bounds, coords, template_step=None):
     h, w = bounds.h, bounds.w
     fovea_x, fovea_y = coords['fovea']
     disc_x, disc_y = coords['disc_edge']
@@ -57,13 +125,44 @@ def get_etdrs_masks(bounds, coords):
     laterality = 'R' if disc_x > fovea_x else 'L'
 
     return ETDRS_masks(
-        h, w, fovea_x, fovea_y, resolution, laterality)
+        h, w, fovea_x, fovea_y, resolution, laterality, template_step)
+
+
+def get_model_space_etdrs(result, coords, template_step=None):
+    '''
+    ETDRS masks and binary feature images in model space (the 1024 crop of the bounds),
+    avoids warping the outputs to the original image.
+    The fovea and disc edge are mapped with the cropping transform, so the resolution
+    is scaled by the transform: resolution_model = resolution / T.scale
+    '''
+    T = result.transform
+    bounds_model = result.bounds.warp(T, warp_image=False)
+    coords_model = {k: T.apply([v])[0] for k, v in coords.items()}
+    etdrs_masks = get_etdrs_masks(bounds_model, coords_model, template_step)
+
+    feature_images = {
+        feature_name: (result.get_model_space(feature_name) >= 0.5) & bounds_model.mask
+        for feature_name in feature_names
+    }
+    return etdrs_masks, feature_images
+
 
+def get_gradability(quality):
+    # column value: the reason codes, 'ok' if the image passed the gate (None without the gate)
+    if quality is None:
+        return None
+    return ';'.join(quality['reasons']) or 'ok'
 
-def export_results_full(output_folder, results):
+
+def export_results_full(output_folder, results, gradability=False):
+    '''
+    results: list of (row, summaries, bounds, coords, gradability), see process_rows
+    gradability: add the gradability column
+    '''
+    import pandas as pd
     try:
         summary, bounds, coords = next(
-            (summary, bounds, coords) for _, summary, bounds, coords
+            (summary, bounds, coords) for _, summary, bounds, coords, _
             in results if summary is not None)
     except StopIteration:
         print('No images were processed successfully')
@@ -77,9 +176,10 @@ def export_results_full(output_folder, results):
     ]
     bounds_header = bounds.list_names
     coords_header = ["disc_edge_x", "disc_edge_y", "fovea_x", "fovea_y"]
+    gradability_header = ['gradability'] if gradability else []
 
     rows = []
-    for row, summary, bounds, coords in results:
+    for row, summary, bounds, coords, quality in results:
         row_out = [row.identifier, row.path]
         rows.append(row_out)
         if summary is None:
@@ -96,11 +196,14 @@ def export_results_full(output_folder, results):
             row_out += [None] * len(coords_header)
         else:
             row_out += [*coords['disc_edge'], *coords['fovea']]
+        if gradability:
+            row_out.append(get_gradability(quality))
 
-    pd.DataFrame(rows, columns=['identifier', 'path'] + summary_header + bounds_header + coords_header).to_csv(
-        f'{output_folder}/results_full.csv', index=False)
+    columns = ['identifier', 'path'] + summary_header + bounds_header + coords_header + gradability_header
+    pd.DataFrame(rows, columns=columns).to_csv(f'{output_folder}/results_full.csv', index=False)
 
-def export_results_area(output_folder, results):
+def export_results_area(output_folder, results, gradability=False):
+    import pandas as pd
     keys = ['total_area', 'grid_area', 'outer_area', 'inner_area', 'center_area']
     summary_header = [
         f'{feature_name}_{k}'
@@ -109,7 +212,7 @@ def export_results_area(output_folder, results):
     ]
     
     rows = []
-    for row, summary, _, _ in results:
+    for row, summary, _, _, quality in results:
         row_out = [row.identifier, row.path]
         rows.append(row_out)
         if summary is None:
@@ -118,46 +221,497 @@ def export_results_area(output_folder, results):
             row_out += [
                 summary[feature_name][k] for feature_name in feature_names for k in keys
             ]
+        if gradability:
+            row_out.append(get_gradability(quality))
     
-    pd.DataFrame(rows, columns=['identifier', 'path'] + summary_header).to_csv(
+    gradability_header = ['gradability'] if gradability else []
+    pd.DataFrame(rows, columns=['identifier', 'path'] + summary_header + gradability_header).to_csv(
         f'{output_folder}/results_area.csv', index=False)
 
 
-def main(csv_path, output_folder, args):
-    print('Loading models...')
-    processor, landmarksProcessor = get_processors()
+def export_results_qc(output_folder, results, mode):
+    import pandas as pd
+    bounds_header = CFIBounds.list_names
+    coords_header = ["disc_edge_x", "disc_edge_y", "fovea_x", "fovea_y", "resolution"]
+    if mode == 'bounds':
+        coords_header = []
+
+    rows = []
+    for row, bounds, coords in results:
+        row_out = [row.identifier, row.path]
+        rows.append(row_out)
+        if bounds is None:
+            row_out += [None] * len(bounds_header)
+        else:
+            row_out += bounds.to_list()
+        if not coords_header:
+            continue
+        if coords is None:
+            row_out += [None] * len(coords_header)
+        else:
+            resolution = get_resolution(*coords['fovea'], *coords['disc_edge'])
+            row_out += [*coords['disc_edge'], *coords['fovea'], resolution]
+
+    pd.DataFrame(rows, columns=['identifier', 'path'] + bounds_header + coords_header).to_csv(
+        f'{output_folder}/results_{mode}.csv', index=False)
+
+
+def process_images_qc(images, landmarksProcessor):
+    # bounds and (optionally) landmarks for a batch of images
+    bounds = get_cfi_bounds_batch(images)
+    if landmarksProcessor is None:
+        coords = [None] * len(images)
+    else:
+        coords = landmarksProcessor.process_batch(images, bounds)
+    return list(zip(bounds, coords))
+
+
+def process_batch_qc(rows, landmarksProcessor):
+    results = {}
+    loaded = []
+    for i, row in enumerate(rows):
+        try:
+            loaded.append((i, open_image(row.path)))
+        except Exception as e:
+            print(f'Error loading image {row.path}: {e}')
+            results[i] = None, None
+
+    try:
+        outputs = process_images_qc([image for _, image in loaded], landmarksProcessor)
+        results.update((i, output) for (i, _), output in zip(loaded, outputs))
+    except Exception:
+        # retry one by one to find the image(s) causing the error
+        for i, image in loaded:
+            try:
+                results[i] = process_images_qc([image], landmarksProcessor)[0]
+            except Exception as e:
+                print(f'Error processing image {rows[i].path}: {e}')
+                results[i] = None, None
+
+    return [(row, *results[i]) for i, row in enumerate(rows)]
+
+
+def main_qc(csv_path, output_folder, args):
+    '''
+    Fast run type for quality control:
+    mode 'bounds' only detects bounds, mode 'landmarks' also detects fovea and disc edge.
+    Skips segmentation and writes a single table results_{mode}.csv
+    '''
+    import pandas as pd
+    landmarksProcessor = None
+    if args.mode == 'landmarks':
+        from .landmarks import LandmarksProcessor
+        print('Loading models...')
+        landmarksProcessor = LandmarksProcessor(get_device(), get_preprocess_cache(args))
 
     df = pd.read_csv(csv_path)
+    rows = [row for _, row in df.iterrows()]
 
     results = []
+    for start in range(0, len(rows), args.batch_size):
+        batch = rows[start:start + args.batch_size]
+        print(f'Processing images {start + 1}-{start + len(batch)}/{len(rows)}')
+        results += process_batch_qc(batch, landmarksProcessor)
+
+    os.makedirs(output_folder, exist_ok=True)
+    export_results_qc(output_folder, results, args.mode)
+
+
+class Runner:
+    '''
+    Processes batches of rows (models, summaries and exports), in the main process
+    or in a worker process (see init_worker)
+    '''
+
+    def __init__(self, output_folder, args, weights=None):
+        '''
+        weights: optional shared weights of the processors (see load_shared_weights)
+        '''
+        import torch
+        if args.torch_threads:
+            torch.set_num_threads(args.torch_threads)
+        self.output_folder = output_folder
+        self.args = args
+        self.processor, self.landmarksProcessor = get_processors(
+            get_preprocess_cache(args), weights, args.model_threads)
+
+        self.mask_store = None
+        if args.mask_format == 'store':
+            self.mask_store = MaskStore(f'{output_folder}/masks')
+
+        self.result_cache = None
+        if args.result_cache_dir is not None:
+            from .result_cache import ResultCache
+            self.result_cache = ResultCache(
+                args.result_cache_dir, int(args.result_cache_size_gb * 1024**3))
+
+        self.executor = ExportExecutor(args.export_workers, args.export_queue)
+
+    def run_batch(self, rows):
+        '''
+        process_batch, measuring the peak memory of the batch
+
+        Returns:
+        - outputs of process_batch
+        - dict with the peak memory, device peak memory and model batch size (see RunStats.add_batch)
+        '''
+        device = self.processor.device
+        reset_peak_memory(device)
+        outputs = self.process_batch(rows)
+        info = {
+            'peak_memory': get_peak_memory(),
+            'device_peak_memory': get_device_peak_memory(device),
+            'model_batch_size': self.processor.batch_size.size,
+        }
+        return outputs, info
+
+    def process_batch(self, rows):
+        '''
+        Returns:
+        - for each row: report, bounds, coords, gradability and a Future for the exports (see process_rows),
+          or None on errors
+        '''
+        submitted = {}
+        try:
+            return process_rows(self.output_folder, self.args, self.processor, self.landmarksProcessor,
+                                rows, self.mask_store, self.executor, self.result_cache, submitted)
+        except Exception as e:
+            if len(rows) == 1:
+                print(f'Error processing image {rows[0].path}: {e}')
+                return [None]
+        # retry one by one to find the image(s) causing the error,
+        # rows exported before the error are not processed (and appended to the mask store) again
+        return [submitted[i] if i in submitted else self.process_batch([row])[0] for i, row in enumerate(rows)]
+
+    def close(self):
+        # waits for the exports
+        self.executor.shutdown()
+
 
-    for idx, row in df.iterrows():
-        print(f'Processing image {idx + 1}/{len(df)}')
+# runner of a worker process
+_runner = None
+
+
+def init_worker(output_folder, args, weights=None):
+    global _runner
+    _runner = Runner(output_folder, args, weights)
+
+
+def run_worker_batch(rows):
+    '''
+    Processes a batch in a worker process and waits for the exports
+
+    Returns:
+    - pid, memory info (see Runner.run_batch) and for each row: summaries, bounds (dict),
+      image size, coords and gradability, or None
+    '''
+    outputs, info = _runner.run_batch(rows)
+    results = []
+    for row, output in zip(rows, outputs):
+        if output is None:
+            results.append(None)
+            continue
+        report, bounds, coords, quality, export = output
         try:
-            report, bounds, coords = process_row(
-                output_folder, args, processor, landmarksProcessor, row)
-            results.append((row, report.summaries, bounds, coords))
+            export.result()
         except Exception as e:
-            print(f'Error processing image {row.path}: {e}')
-            results.append((row, None, None, None))
+            print(f'Error exporting image {row.path}: {e}')
+            results.append(None)
+            continue
+        summaries = None if report is None else report.summaries
+        results.append((summaries, bounds.to_dict(), (bounds.h, bounds.w), coords, quality))
+    return os.getpid(), info, results
 
-    export_results_full(output_folder, results)
-    export_results_area(output_folder, results)
 
+def run_local(output_folder, args, batches, stats):
+    print('Loading models...')
+    runner = Runner(output_folder, args)
+    n_rows = sum(len(batch) for batch in batches)
 
-def process_row(output_folder, args, processor, landmarksProcessor, row):
-    print(f'loading image {row.path}')
-    image = open_image(row.path)
+    results = []
+    exports = []
+    try:
+        for batch in batches:
+            print(f'Processing images {len(results) + 1}-{len(results) + len(batch)}/{n_rows}')
+            outputs, info = runner.run_batch(batch)
+            for row, output in zip(batch, outputs):
+                if output is None:
+                    results.append((row, None, None, None, None))
+                    continue
+                report, bounds, coords, quality, export = output
+                exports.append((len(results), export))
+                # images failing the gradability gate have no report
+                summaries = None if report is None else report.summaries
+                results.append((row, summaries, bounds, coords, quality))
+            stats.add_batch(len(batch), **info)
+    finally:
+        runner.close()
+
+    for i, export in exports:
+        try:
+            export.result()
+        except Exception as e:
+            row = results[i][0]
+            print(f'Error exporting image {row.path}: {e}')
+            results[i] = (row, None, None, None, None)
+    return results
+
+
+def run_pool(output_folder, args, batches, stats):
+    '''
+    Processes the batches in args.workers worker processes.
+    With args.shared_weights on CPU, the models are loaded once in shared memory and used by all workers,
+    otherwise each worker loads its own models.
+    '''
+    weights = None
+    if args.shared_weights and args.device_type == 'cpu':
+        print('Loading models in shared memory...')
+        weights = load_shared_weights()
+        stats.shared_memory = sum(w.nbytes for w in weights)
+
+    print(f'Starting {args.workers} worker processes...')
+    n_rows = sum(len(batch) for batch in batches)
+    results = []
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(args.workers, init_worker, (output_folder, args, weights)) as pool:
+        for batch, (pid, info, outputs) in zip(batches, pool.imap(run_worker_batch, batches)):
+            for row, output in zip(batch, outputs):
+                if output is None:
+                    results.append((row, None, None, None, None))
+                    continue
+                summaries, bounds, (h, w), coords, quality = output
+                # geometry only, the image is not needed for the tables
+                bounds = CFIBounds.from_dict(np.empty((h, w, 0), dtype=np.uint8), bounds)
+                results.append((row, summaries, bounds, coords, quality))
+            stats.add_batch(len(batch), pid, **info)
+            print(f'Processed images {len(results)}/{n_rows}')
+    return results
 
-    result = processor.process(image)
-    bounds = result['bounds']
-    coords = landmarksProcessor.process(image, bounds)
 
+def main(csv_path, output_folder, args):
+    '''
+    Returns:
+    - RunStats of the run (full mode)
+    '''
+    if args.mode == 'bounds':
+        # no models: torch is not needed and the machine profile (made for the models) is not applied
+        args.batch_size = args.batch_size or 8
+        return main_qc(csv_path, output_folder, args)
+
+    import pandas as pd
+    import torch
+    args.device_type = get_device().type
+    if args.mode == 'full' and args.profile != 'none':
+        # the profile is tuned for the segmentation models (threads per worker process, batch size),
+        # landmarks mode keeps its own defaults
+        apply_profile(args, load_profile(args.profile))
+    if args.torch_threads:
+        torch.set_num_threads(args.torch_threads)
+
+    if args.mode != 'full':
+        args.batch_size = args.batch_size or 8
+        return main_qc(csv_path, output_folder, args)
+
+    args.batch_size = args.batch_size or 1
+    args.workers = args.workers or 1
+    if args.workers > 1 and args.mask_format == 'store':
+        raise ValueError('mask_format store can not be used with more than one worker process')
+
+    os.makedirs(output_folder, exist_ok=True)
+    if args.export_html_report and args.shared_report_css:
+        export_style(f'{output_folder}/report.css')
+
+    df = pd.read_csv(csv_path)
+    rows = [row for _, row in df.iterrows()]
+    batches = [rows[start:start + args.batch_size] for start in range(0, len(rows), args.batch_size)]
+
+    stats = RunStats()
+    if args.workers > 1:
+        results = run_pool(output_folder, args, batches, stats)
+    else:
+        results = run_local(output_folder, args, batches, stats)
+
+    export_results_full(output_folder, results, args.gradability_gate)
+    export_results_area(output_folder, results, args.gradability_gate)
+    with open(f'{output_folder}/run_stats.json', 'w') as f:
+        json.dump(stats.to_dict(include_batches=True), f, indent=2)
+    return stats
+
+
+def get_cache_config(processor, args):
+    # all settings that change the cached results
+    return {
+        'models': processor.models_fingerprint,
+        'mode': processor.mode,
+        'thresholds': processor.thresholds,
+        'thresholds_global': processor.thresholds_global,
+        'measure_in_model_space': args.measure_in_model_space,
+        'etdrs_template_step': args.etdrs_template_step,
+    }
+
+
+def process_row(output_folder, args, processor, landmarksProcessor, row, mask_store=None, executor=None,
+                result_cache=None):
+    '''
+    Runs the models and the ETDRS summaries, the exports are submitted to executor
+    (or run synchronously if executor is None)
+
+    Returns:
+    - report, bounds, coords, gradability and a Future for the exports (see process_rows)
+    '''
+    return process_rows(output_folder, args, processor, landmarksProcessor, [row],
+                        mask_store, executor, result_cache)[0]
+
+
+def process_rows(output_folder, args, processor, landmarksProcessor, rows, mask_store=None, executor=None,
+                 result_cache=None, submitted=None):
+    '''
+    process_row for a list of rows, running the models on the images together.
+    With a result_cache, images processed before (same pixel data and settings) skip the models
+    and the summaries, the exports are still written.
+    With args.gradability_gate, images failing the gate (see utils.gradability) skip the models,
+    only their bounds and gradability are exported.
+    With a submitted dict, the output of each row is added (by index) as soon as its exports are submitted,
+    so a caller can tell which rows were exported when a later row fails.
+
+    Returns:
+    - for each row: report, bounds, coords, gradability (None without the gate) and a Future for the exports.
+      report and coords are None for images failing the gate
+    '''
+    images = []
+    for row in rows:
+        print(f'loading image {row.path}')
+        images.append(open_image(row.path))
+
+    bounds = [None] * len(rows)
+    qualities = [None] * len(rows)
+    if args.gradability_gate:
+        bounds, qualities = check_gradability_batch(images)
+        for row, quality in zip(rows, qualities):
+            if quality['reasons']:
+                print(f"skipping ungradable image {row.path}: {', '.join(quality['reasons'])}")
+
+    gradable = [quality is None or not quality['reasons'] for quality in qualities]
+
+    # the pixel data is hashed once, for the result cache and the preprocess caches
+    image_hashes = [None] * len(rows)
+    if result_cache is not None or processor.preprocess_cache is not None:
+        image_hashes = [get_image_hash(image) if g else None for image, g in zip(images, gradable)]
+
+    keys = [None] * len(rows)
+    cached = [None] * len(rows)
+    # cached results have no folds
+    if result_cache is not None and not args.export_folds:
+        config = get_cache_config(processor, args)
+        for i, image in enumerate(images):
+            if not gradable[i]:
+                continue
+            keys[i] = result_cache.get_key(image, config, image_hashes[i])
+            cached[i] = result_cache.get(keys[i], image)
+            if cached[i] is not None:
+                print(f'using cached result for {rows[i].path}')
+
+    todo = [i for i, c in enumerate(cached) if c is None and gradable[i]]
+    if todo:
+        todo_images = [images[i] for i in todo]
+        todo_hashes = [image_hashes[i] for i in todo]
+        results = processor.process_batch(todo_images, keep_folds=args.export_folds,
+                                          bounds=[bounds[i] for i in todo], image_hashes=todo_hashes)
+        coords = landmarksProcessor.process_batch(todo_images, [r['bounds'] for r in results], todo_hashes)
+        for i, result, c in zip(todo, results, coords):
+            cached[i] = result, c, None
+
+    if executor is None:
+        executor = ExportExecutor(workers=0)
+
+    outputs = []
+    for i, (row, image, key, quality) in enumerate(zip(rows, images, keys, qualities)):
+        if cached[i] is None:
+            # failed the gradability gate
+            export = executor.submit(export_ungradable, output_folder, args, row, bounds[i], quality)
+            outputs.append((None, bounds[i], None, quality, export))
+            if submitted is not None:
+                submitted[i] = outputs[-1]
+            continue
+
+        result, coords, summaries = cached[i]
+        report = make_report(args, result, coords, summaries)
+
+        if key is not None and summaries is None:
+            result_cache.put(key, result, coords, report.summaries)
+
+        export = executor.submit(
+            export_row, output_folder, args, row, image, result, coords, report, mask_store, quality)
+        outputs.append((report, result['bounds'], coords, quality, export))
+        if submitted is not None:
+            submitted[i] = outputs[-1]
+    return outputs
+
+
+def make_report(args, result, coords, summaries=None):
+    # ETDRS summaries of the binary feature images
+    if args.measure_in_model_space:
+        etdrs_masks, feature_images = get_model_space_etdrs(
+            result, coords, args.etdrs_template_step)
+    else:
+        etdrs_masks = get_etdrs_masks(result['bounds'], coords, args.etdrs_template_step)
+
+        feature_images = {
+            feature_name: result[feature_name] >= 0.5
+            for feature_name in feature_names
+        }
+    return Report(feature_images, etdrs_masks, etdrs_masks.all_fields, summaries)
+
+
+def get_feature_images(args, result, report):
+    # full size binary feature images: those of the report, unless it has the model space images
+    if args.measure_in_model_space:
+        return {
+            feature_name: result[feature_name] >= 0.5
+            for feature_name in feature_names
+        }
+    return report.feature_images
+
+
+def export_gradability(base_path, quality):
+    with open(f'{base_path}/gradability.json', 'w') as f:
+        json.dump(quality, f)
+
+
+def export_ungradable(output_folder, args, row, bounds, quality):
+    # an image that failed the gradability gate: bounds and the gradability only
+    base_path = f'{output_folder}/{row.identifier}'
+    os.makedirs(base_path, exist_ok=True)
+    export_gradability(base_path, quality)
+    if args.export_bounds:
+        with open(f'{base_path}/bounds.json', 'w') as f:
+            json.dump(bounds.to_dict(), f)
+
+
+def export_row(output_folder, args, row, image, result, coords, report, mask_store=None, quality=None):
+    bounds = result['bounds']
     base_path = f'{output_folder}/{row.identifier}'
     os.makedirs(base_path, exist_ok=True)
 
-    export_features(result, base_path,
-                    args.export_probability, args.skip_empty)
+    if quality is not None:
+        export_gradability(base_path, quality)
+
+    # each result[feature] warps the model output to full size: the binary images are warped once,
+    # for the masks and the polygons
+    feature_images = None
+    if not args.export_probability or args.export_polygons:
+        feature_images = get_feature_images(args, result, report)
+
+    if args.mask_format == 'png':
+        export_features(result, base_path,
+                        args.export_probability, args.skip_empty, feature_images)
+    else:
+        export_features_packed(result, base_path, args.export_probability,
+                               args.mask_compression, mask_store, row.identifier, feature_images)
+
+    if getattr(args, 'export_folds', False) and result.folds is not None:
+        save_folds(f'{base_path}/folds.npz', result.folds, bounds,
+                   result.transform, coords, args.folds_dtype)
 
     if args.export_bounds:
         with open(f'{base_path}/bounds.json', 'w') as f:
@@ -167,39 +721,113 @@ def process_row(output_folder, args, processor, landmarksProcessor, row):
         with open(f'{base_path}/coordinates.json', 'w') as f:
             json.dump({k: v.tolist() for k, v in coords.items()}, f)
 
-    etdrs_masks = get_etdrs_masks(bounds, coords)
-
-    feature_images = {
-        feature_name: result[feature_name] >= 0.5
-        for feature_name in feature_names
-    }
-    report = Report(feature_images, etdrs_masks, etdrs_masks.all_fields)
-
+    if args.export_polygons:
+        if args.measure_in_model_space:
+            # outlines in the original image
+            resolution = get_resolution(*coords['fovea'], *coords['disc_edge'])
+        else:
+            resolution = report.etdrs.resolution
+        export_lesion_polygons(f'{base_path}/lesions.geojson', feature_images,
+                               resolution, bounds)
+
+    if args.measure_in_model_space:
+        # the report shows the model space crop
+        image = result.transform.warp(image)
+
+    css_href = None
+    if args.shared_report_css:
+        # identifiers can contain '/' (nested folders), the link is relative to the report
+        css_href = os.path.relpath(f'{output_folder}/report.css', base_path).replace(os.sep, '/')
     report.export(base_path, image, row.identifier,
-                  args.export_html_report, True)
+                  args.export_html_report, True, args.report_image_format, css_href)
 
-    return report, bounds, coords
 
-
-if __name__ == "__main__":
-    import argparse
-
-    parser = argparse.ArgumentParser(
-        description='Run inference on images listed in a CSV file.')
-    parser.add_argument('--csv_path', type=str,
-                        help='Path to the CSV file containing image paths.', default='/input.csv')
-    parser.add_argument('--output_folder', type=str,
-                        help='Folder to store the inference results.', default='/output')
+def add_export_arguments(parser):
+    # arguments of the per-image outputs, shared with cfi_amd.recombine
     parser.add_argument('--export_probability', action=argparse.BooleanOptionalAction, default=False,
                         help='Export probability maps instead of binary masks')
+    parser.add_argument('--mask_format', type=str, choices=['png', 'npz', 'store'], default='png',
+                        help='png: one image per feature, npz: all masks of an image in one file, '
+                        'store: all masks in chunk files in output_folder/masks')
+    parser.add_argument('--mask_compression', type=str, choices=['deflate', 'zstd'], default='deflate',
+                        help='Compression for the npz and store mask formats (zstd requires the zstandard package)')
+    parser.add_argument('--export_polygons', action=argparse.BooleanOptionalAction, default=False,
+                        help='Export lesion outlines with their area in mm² (lesions.geojson)')
     parser.add_argument('--skip_empty', action=argparse.BooleanOptionalAction, default=True,
                         help='Skip exporting empty segmentation masks')
     parser.add_argument('--export_html_report', action=argparse.BooleanOptionalAction, default=True,
                         help='Export HTML report with ETDRS grid and feature masks')
+    parser.add_argument('--report_image_format', type=str, choices=['JPEG', 'WEBP', 'PNG'], default='JPEG',
+                        help='Format of the images embedded in the HTML report')
+    parser.add_argument('--shared_report_css', action=argparse.BooleanOptionalAction, default=False,
+                        help='Write the report style sheet once to the output folder and link it from each report')
     parser.add_argument('--export_coordinates', action=argparse.BooleanOptionalAction, default=True,
                         help='Export coordinates of fovea and disc edge')
     parser.add_argument('--export_bounds', action=argparse.BooleanOptionalAction, default=True,
                         help='Export bounds of the image')
 
-    args = parser.parse_args()
+    parser.add_argument('--measure_in_model_space', action=argparse.BooleanOptionalAction, default=False,
+                        help='Compute the ETDRS measurements on the 1024 px model output instead of '
+                        'full resolution masks (faster, the agreement is not validated, see README)')
+    parser.add_argument('--etdrs_template_step', type=float, default=None,
+                        help='Cut the ETDRS grid from cached templates, with the grid radius rounded to '
+                        'multiples of this number of pixels and the fovea rounded to the nearest pixel')
+    parser.add_argument('--export_workers', type=int, default=2,
+                        help='Number of threads writing outputs while the next image is processed (0: no threads)')
+    parser.add_argument('--export_queue', type=int, default=4,
+                        help='Maximum number of images waiting to be exported')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Run inference on images listed in a CSV file.')
+    parser.add_argument('--csv_path', type=str,
+                        help='Path to the CSV file containing image paths.', default='/input.csv')
+    parser.add_argument('--output_folder', type=str,
+                        help='Folder to store the inference results.', default='/output')
+    add_export_arguments(parser)
+    parser.add_argument('--export_folds', action=argparse.BooleanOptionalAction, default=False,
+                        help='Export the output of each model (folds.npz), to re-combine the ensembles '
+                        'with another mode or thresholds without inference (see cfi_amd.recombine)')
+    parser.add_argument('--folds_dtype', type=str, choices=['uint8', 'float16'], default='uint8',
+                        help='Data type of the exported folds')
+    parser.add_argument('--result_cache_dir', type=str, default=None,
+                        help='Folder of a persistent cache of results, duplicate images (same pixel data) '
+                        'are processed once. Cached probability maps are quantised to uint8')
+    parser.add_argument('--result_cache_size_gb', type=float, default=10,
+                        help='Maximum size of the result cache, least recently used entries are removed')
+    parser.add_argument('--preprocess_cache_dir', type=str, default=None,
+                        help='Folder of a persistent cache of the preprocessed model inputs (bounds, crops and '
+                        'contrast enhanced images), reruns on the same images only run the models')
+    parser.add_argument('--mode', type=str, choices=['full', 'landmarks', 'bounds'], default='full',
+                        help='full: segmentation and reports, landmarks: bounds, fovea and disc edge only, '
+                        'bounds: bounds only')
+    parser.add_argument('--batch_size', type=int, default=None,
+                        help='Number of images processed together (default: machine profile, '
+                        'or 1 in full mode and 8 in landmarks and bounds modes)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes in full mode (default: machine profile or 1)')
+    parser.add_argument('--shared_weights', action=argparse.BooleanOptionalAction, default=True,
+                        help='With more than one worker process on CPU, load the model weights once in '
+                        'shared memory instead of in each worker')
+    parser.add_argument('--torch_threads', type=int, default=None,
+                        help='Number of torch threads in each worker process '
+                        '(default: machine profile or the torch default)')
+    parser.add_argument('--model_threads', type=int, default=1,
+                        help='Number of segmentation models run concurrently in each worker process, '
+                        'each with torch_threads / model_threads threads (CPU, lowers the time per image '
+                        'on machines with many cores)')
+    parser.add_argument('--gradability_gate', action=argparse.BooleanOptionalAction, default=False,
+                        help='Check the images before the models run (bounds, edge contrast, exposure) and skip '
+                        'the models for images that fail. The reasons are written to gradability.json '
+                        'and the gradability column of the tables')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='Machine profile made by cfi_amd.autotune (default: the profile in the '
+                        "user cache directory, if it exists), applied in full mode, 'none' to ignore it")
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
     main(args.csv_path, args.output_folder, args)
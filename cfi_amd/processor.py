@@ -1,13 +1,19 @@
 from .model import UNet
-import lightning as L
 import torch
 import numpy as np
+import gc
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from .ensemble import ProcessResult, combine_ensemble, combine_folds, thresholds, thresholds_global
 from .utils.mask_extraction import get_cfi_bounds
 from pathlib import Path
-from .resources import get_models_base_dir, ensure_models_downloaded
+from .resources import get_models_base_dir, ensure_models_downloaded, get_models_fingerprint
+from .utils.adaptive_batch import AdaptiveBatchSize
+from .utils.shared_weights import SharedWeights
 
 
-class Model(L.LightningModule):
+class Model(torch.nn.Module):
 
     def __init__(self, out_channels):
         super().__init__()
@@ -37,21 +43,46 @@ class Model2(Model):
         super().__init__(2)
 
 
-def load_models(feature, device, models_dir=None):    
+def load_state_dict(path, device):
+    '''
+    State dict of a Lightning checkpoint, read without Lightning
+    '''
+    try:
+        checkpoint = torch.load(path, map_location=device, weights_only=True)
+    except pickle.UnpicklingError:
+        # other objects in the checkpoint (e.g. hyperparameters) need their classes to be unpickled
+        checkpoint = torch.load(path, map_location=device, weights_only=False)
+    return checkpoint['state_dict']
+
+
+def load_models(feature, device, models_dir=None, weights=None):
+    '''
+    weights: optional utils.shared_weights.SharedWeights with the weights of the models
+    (see Processor.share_weights), used instead of the checkpoints
+    '''
+    # pigment model segments both RPE degeneration and hyperpigmentation
+    constructor = Model2 if feature == 'pigment' else Model1
+    if weights is not None:
+        models = []
+        for i in range(5):
+            # no memory is allocated for the weights of the new model
+            with torch.device('meta'):
+                model = constructor()
+            models.append(weights.attach(f'{feature}_{i}', model))
+        return models
+
     base_dir = get_models_base_dir(models_dir)
     ensure_models_downloaded(base_dir)
     feature_dir = Path(base_dir) / feature
-    # pigment model segments both RPE degeneration and hyperpigmentation
-    constructor = Model2 if feature == 'pigment' else Model1
     models = []
     print(f"loading model: {feature_dir}")
     for i in range(5):
-        ckpt = feature_dir / f'model_{i}.ckpt'        
-        models.append(
-            constructor.load_from_checkpoint(
-                checkpoint_path=str(ckpt),
-                map_location=device)
-        )
+        ckpt = feature_dir / f'model_{i}.ckpt'
+        # the weights are not initialised, they are replaced by those of the checkpoint
+        with torch.device('meta'):
+            model = constructor()
+        model.load_state_dict(load_state_dict(str(ckpt), device), assign=True)
+        models.append(model)
     return models
 
 
@@ -59,59 +90,104 @@ def load_models(feature, device, models_dir=None):
 features = 'drusen', 'pigment', 'RPD'
 
 
+def get_device_key(device):
+    # name of the device in the batch size history
+    device = torch.device(device)
+    if device.type == 'cuda':
+        return f'cuda:{torch.cuda.get_device_name(device)}'
+    return f'{device.type}:{os.cpu_count()}'
+
+
 class Processor:
 
-    def __init__(self, device, mode="th_0.5", models_dir=None):
+    def __init__(self, device, mode="th_0.5", models_dir=None, preprocess_cache=None, weights=None,
+                 model_threads=1):
         '''
         args:
         device: torch device
         mode: "th_0.5" or "th_optimal"
         models_dir: optional path to the folder containing model checkpoints
+        preprocess_cache: optional utils.preprocess_cache.PreprocessCache for the model inputs
+        weights: optional utils.shared_weights.SharedWeights made by share_weights in another process
+        model_threads: number of models run concurrently (on CPU), the torch threads are divided over them
         '''
         self.device = device
         self.mode = mode
         self.models_dir = models_dir
+        self.preprocess_cache = preprocess_cache
         self.models = {
-            feature: load_models(feature, device, models_dir=self.models_dir)
+            feature: load_models(feature, device, models_dir=self.models_dir, weights=weights)
             for feature in features
         }
+        # identifies the checkpoints and landmark models (e.g. in the result cache key)
+        self.models_fingerprint = get_models_fingerprint(self.models_dir)
 
         for models in self.models.values():
             for model in models:
                 model.to(device)
                 model.eval()
 
-        # optimal thresholds for each model
-        # based on average dice score on validation images with reference segmentation
-        self.thresholds = {
-            'drusen': (0.81, 0.76, 0.44, 0.72, 0.58),
-            'rpe_degeneration': (0.53, 0.8, 0.75, 0.74, 0.09),
-            'hyperpigmentation': (0.44, 0.47, 0.65, 0.22, 0.28),
-            'RPD': (0.19, 0.11, 0.08, 0.07, 0.39),
-        }
-        # optimal thresholds for each model
-        # based on single dice score on full validation set
-        self.thresholds_global = {
-            'drusen': (0.85, 0.74, 0.47, 0.66, 0.69),
-            'rpe_degeneration': (0.75, 0.76, 0.45, 0.65, 0.60),
-            'hyperpigmentation': (0.59, 0.92, 0.74, 0.78, 0.37),
-            'RPD': (0.85, 0.34, 0.78, 0.72, 0.70)
-        }
+        self.thresholds = dict(thresholds)
+        self.thresholds_global = dict(thresholds_global)
+
+        # model batches are halved on allocation failures (see predict_folds_batch)
+        self.batch_size = AdaptiveBatchSize(get_device_key(device))
+
+        self.model_threads = model_threads
+        self.executor = ThreadPoolExecutor(model_threads) if model_threads > 1 else None
 
     def combine_ensemble(self, y_preds, thresholds):
-        if self.mode == "th_0.5":
-            return np.mean(y_preds, axis=0)
-        elif self.mode == "th_optimal":
-            result = np.zeros_like(y_preds[0])
-            for th, y_pred in zip(thresholds, y_preds):
-                result += y_pred ** (np.log(th) / np.log(0.5))
-            return result / 5
+        return combine_ensemble(y_preds, thresholds, self.mode)
+
+    def share_weights(self):
+        '''
+        Copies the weights of the models (on CPU) to shared memory, for Processors in worker processes
+
+        Returns:
+        - utils.shared_weights.SharedWeights
+        '''
+        return SharedWeights({
+            f'{feature}_{i}': model
+            for feature, models in self.models.items()
+            for i, model in enumerate(models)
+        })
+
+    def process(self, image, radius_fraction=1, quantize=False, keep_folds=False):
+        '''
+        args:
+        image: numpy array (h, w, 3) uint8
+        radius_fraction: fraction of the radius of the bounds used for contrast enhancement
+        quantize: store the outputs as uint8 (see ProcessResult)
+        keep_folds: keep the output of each model in result.folds (e.g. to save with utils.fold_store)
+        '''
+        bounds, T, folds = self.predict_folds(image, radius_fraction)
+        maps = combine_folds(folds, self.thresholds, self.mode)
+        return ProcessResult(bounds, T, maps, quantize, folds if keep_folds else None)
 
-    def process(self, image, radius_fraction=1):
-        bounds = get_cfi_bounds(image)
-        T, bounds_cropped = bounds.crop(1024)
+    def preprocess(self, image, radius_fraction=1, bounds=None, image_hash=None):
+        '''
+        Bounds, cropping transform and the uint8 model input (1024, 1024, 9):
+        the cropped image and the contrast enhanced images (5 and 10).
+        Loaded from / saved to self.preprocess_cache (if set and radius_fraction == 1)
+        bounds: optional CFIBounds of the image (detected if None)
+        image_hash: optional utils.utils.get_image_hash of the image (for the cache key)
+        '''
+        cache = self.preprocess_cache if radius_fraction == 1 else None
+        if cache is not None:
+            key = cache.get_key(image, image_hash)
+            cached = cache.load(image, 1024, key)
+            if cached is not None:
+                return cached
 
-        bounds_cropped.radius = radius_fraction * bounds_cropped.radius
+        if bounds is None:
+            bounds = get_cfi_bounds(image)
+        if radius_fraction == 1:
+            T, bounds_cropped = bounds.crop(1024)
+        else:
+            # don't modify the cached crop
+            T = bounds.get_cropping_transform(1024)
+            bounds_cropped = bounds.warp(T)
+            bounds_cropped.radius = radius_fraction * bounds_cropped.radius
 
         images = np.concatenate([
             bounds_cropped.image,
@@ -119,34 +195,101 @@ class Processor:
             bounds_cropped.contrast_enhanced_10
         ], axis=2)
 
-        x = np.transpose(images, (2, 0, 1)).astype(np.float32) / 255.0
-        x = torch.tensor(x).unsqueeze(0).to(self.device)
+        # the cropped image and contrast enhanced images are no longer needed
+        del bounds_cropped
+        bounds.release_crop(1024)
 
-        result = {
-            'bounds': bounds
-        }
-        for feature, models in self.models.items():
-            y_preds = []
-            for model in models:
-                y_pred = model(x)
-                y_np = torch.sigmoid(y_pred).detach().cpu().numpy()
-                y_preds.append(y_np.squeeze())
-
-            y_preds = np.array(y_preds)
-
-            if feature == 'pigment':
-                # pigment model has 2 output channels
-                for i, f in enumerate(['rpe_degeneration', 'hyperpigmentation']):
-                    y_pred_feature = y_preds[:, i]
-                    y_pred = self.combine_ensemble(
-                        y_pred_feature, self.thresholds[f])
-                    y_orig = T.warp_inverse(y_pred)
-                    y_orig[~bounds.mask] = 0
-                    result[f] = y_orig
-            else:
-                y_pred = self.combine_ensemble(
-                    y_preds, self.thresholds[feature])
-                y_orig = T.warp_inverse(y_pred)
-                y_orig[~bounds.mask] = 0
-                result[feature] = y_orig
-        return result
+        if cache is not None:
+            cache.save(image, 1024, bounds, T, images, key)
+        return bounds, T, images
+
+    def process_batch(self, images, quantize=False, keep_folds=False, bounds=None, image_hashes=None):
+        '''
+        process for a list of images, running each model once on the stacked inputs
+        bounds: optional list of CFIBounds (one for each image)
+        image_hashes: optional list of image hashes (see preprocess)
+
+        Returns:
+        - list of ProcessResult
+        '''
+        if bounds is None:
+            bounds = [None] * len(images)
+        if image_hashes is None:
+            image_hashes = [None] * len(images)
+        inputs = [
+            self.preprocess(image, bounds=b, image_hash=h)
+            for image, b, h in zip(images, bounds, image_hashes)
+        ]
+        folds = self.predict_folds_batch([x for _, _, x in inputs])
+        return [
+            ProcessResult(bounds, T, combine_folds(f, self.thresholds, self.mode),
+                          quantize, f if keep_folds else None)
+            for (bounds, T, _), f in zip(inputs, folds)
+        ]
+
+    def predict_folds(self, image, radius_fraction=1):
+        '''
+        Runs all models, without combining the ensembles
+
+        Returns:
+        - bounds: CFIBounds of the image
+        - T: ProjectiveTransform from the image to model space
+        - folds: dict with an array (5, 1024, 1024) for each feature, the sigmoid output of each model
+        '''
+        bounds, T, images = self.preprocess(image, radius_fraction)
+        return bounds, T, self.predict_folds_batch([images])[0]
+
+    def predict_folds_batch(self, inputs):
+        '''
+        inputs: list of uint8 model inputs (1024, 1024, 9), see preprocess
+        The models run on chunks of at most self.batch_size.size inputs, which are halved
+        and retried on allocation failures (see utils.adaptive_batch)
+
+        Returns:
+        - list of folds (see predict_folds), one for each input
+        '''
+        return self.batch_size.run(self.run_models, inputs, self.release_memory)
+
+    def release_memory(self):
+        gc.collect()
+        if torch.device(self.device).type == 'cuda':
+            torch.cuda.empty_cache()
+
+    def run_model(self, model, x, threads=None):
+        # grad mode and the number of torch threads are set per thread
+        if threads is not None:
+            torch.set_num_threads(threads)
+        with torch.no_grad():
+            return torch.sigmoid(model(x)).cpu().numpy()
+
+    def run_models(self, inputs):
+        # converted on the device, the uint8 input is 4 times smaller to transfer
+        x = torch.from_numpy(np.stack(inputs)).to(self.device)
+        x = x.permute(0, 3, 1, 2).float() / 255.0
+
+        models = [model for feature_models in self.models.values() for model in feature_models]
+        if self.executor is None:
+            outputs = [self.run_model(model, x) for model in models]
+        else:
+            threads = torch.get_num_threads()
+            model_threads = max(1, threads // self.model_threads)
+            try:
+                # results in the order of models, the same as running them one by one
+                outputs = list(self.executor.map(lambda model: self.run_model(model, x, model_threads), models))
+            finally:
+                torch.set_num_threads(threads)
+
+        folds = [{} for _ in inputs]
+        outputs = iter(outputs)
+        for feature, feature_models in self.models.items():
+            # (batch, models, channels, h, w)
+            y_preds = np.stack([next(outputs) for _ in feature_models], axis=1)
+
+            for f_i, y_pred in zip(folds, y_preds):
+                if feature == 'pigment':
+                    # pigment model has 2 output channels
+                    for i, f in enumerate(['rpe_degeneration', 'hyperpigmentation']):
+                        f_i[f] = y_pred[:, i]
+                else:
+                    f_i[feature] = y_pred[:, 0]
+        return folds
@@ -0,0 +1,123 @@
+"""
+Re-combines the ensembles from the folds exported by cfi_amd.main (--export_folds),
+with another ensemble mode or other thresholds, without running the models.
+Regenerates the masks, reports and result tables (CPU only).
+
+Usage:
+python -m cfi_amd.recombine --csv_path input.csv --folds_folder /output --output_folder /output_optimal \
+    --ensemble_mode th_optimal --thresholds global
+"""
+
+import json
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+from .main import add_export_arguments, make_report, export_row, export_results_full, export_results_area
+from .ensemble import ProcessResult, combine_folds, thresholds, thresholds_global
+from .utils.utils import open_image
+from .utils.report import export_style
+from .utils.packed_masks import MaskStore
+from .utils.export_executor import ExportExecutor
+from .utils.fold_store import load_folds
+from .utils.cfi_bounds import CFIBounds
+from .utils.transformation import ProjectiveTransform
+
+
+def get_thresholds(name):
+    '''
+    name: 'default' (Processor.thresholds), 'global' (Processor.thresholds_global)
+    or the path to a json file with 5 thresholds for each feature
+    '''
+    if name == 'default':
+        return thresholds
+    if name == 'global':
+        return thresholds_global
+    with open(name) as f:
+        return json.load(f)
+
+
+def recombine_row(folds_folder, output_folder, args, row, thresholds, mask_store=None, executor=None):
+    '''
+    Returns:
+    - report, bounds, coords and a Future for the exports (as main.process_row)
+    '''
+    folds, meta = load_folds(f'{folds_folder}/{row.identifier}/folds.npz')
+    # the image is only used for its size and the report
+    image = open_image(row.path)
+    bounds = CFIBounds.from_dict(image, meta['bounds'])
+    transform = ProjectiveTransform.from_dict(meta['transform'])
+    coords = {k: np.array(v) for k, v in meta['coords'].items()}
+
+    maps = combine_folds(folds, thresholds, args.ensemble_mode)
+    result = ProcessResult(bounds, transform, maps)
+    report = make_report(args, result, coords)
+
+    if executor is None:
+        executor = ExportExecutor(workers=0)
+    export = executor.submit(
+        export_row, output_folder, args, row, image, result, coords, report, mask_store)
+    return report, bounds, coords, export
+
+
+def main(csv_path, folds_folder, output_folder, args):
+    thresholds = get_thresholds(args.thresholds)
+
+    os.makedirs(output_folder, exist_ok=True)
+    if args.export_html_report and args.shared_report_css:
+        export_style(f'{output_folder}/report.css')
+
+    mask_store = None
+    if args.mask_format == 'store':
+        mask_store = MaskStore(f'{output_folder}/masks')
+
+    df = pd.read_csv(csv_path)
+
+    results = []
+    exports = []
+
+    with ExportExecutor(args.export_workers, args.export_queue) as executor:
+        for idx, row in df.iterrows():
+            print(f'Re-combining image {idx + 1}/{len(df)}')
+            try:
+                report, bounds, coords, export = recombine_row(
+                    folds_folder, output_folder, args, row, thresholds, mask_store, executor)
+                exports.append((len(results), export))
+                results.append((row, report.summaries, bounds, coords, None))
+            except Exception as e:
+                print(f'Error re-combining image {row.path}: {e}')
+                results.append((row, None, None, None, None))
+
+    for i, export in exports:
+        try:
+            export.result()
+        except Exception as e:
+            row = results[i][0]
+            print(f'Error exporting image {row.path}: {e}')
+            results[i] = (row, None, None, None, None)
+
+    export_results_full(output_folder, results)
+    export_results_area(output_folder, results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Re-combine exported folds with another ensemble mode or thresholds.')
+    parser.add_argument('--csv_path', type=str,
+                        help='Path to the CSV file containing image paths.', default='/input.csv')
+    parser.add_argument('--folds_folder', type=str,
+                        help='Output folder of the inference run (with --export_folds).', default='/output')
+    parser.add_argument('--output_folder', type=str,
+                        help='Folder to store the re-combined results (can be the same as folds_folder).',
+                        default='/output')
+    parser.add_argument('--ensemble_mode', type=str, choices=['th_0.5', 'th_optimal'], default='th_0.5',
+                        help='th_0.5: mean of the model outputs, th_optimal: outputs rescaled with the '
+                        'optimal threshold of each model')
+    parser.add_argument('--thresholds', type=str, default='default',
+                        help="Thresholds for th_optimal: 'default', 'global' or the path to a json file "
+                        "with 5 thresholds for each feature")
+    add_export_arguments(parser)
+
+    args = parser.parse_args()
+    main(args.csv_path, args.folds_folder, args.output_folder, args)
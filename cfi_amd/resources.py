@@ -45,9 +45,11 @@ def get_models_base_dir(models_dir: str | Path | None = None) -> Path:
     """Resolve the models base directory.
 
     - If models_dir is provided, use it.
-    - Else, try to infer from a git/pyproject repo checkout.
-    - If neither works, raise a clear error instructing the user.
+    - Else, use the CFI_AMD_MODELS_DIR environment variable if set (e.g. in the Docker image).
+    - Else, use the default user cache directory.
     """
+    if models_dir is None:
+        models_dir = os.getenv("CFI_AMD_MODELS_DIR")
     base = Path(models_dir) if models_dir is not None else default_models_dir()
     return base
 
@@ -136,6 +138,24 @@ def _unzip(zip_path: Path, target_dir: Path) -> None:
             zf.extractall(target_dir)
 
 
+def get_models_fingerprint(models_dir: str | Path | None = None) -> list:
+    """Identify the model files under the models directory, e.g. for cache keys.
+
+    Returns a sorted list of [relative path, size, modification time (ns)] of the checkpoints
+    and landmark models (the files of ASSETS), missing files are left out.
+    """
+    base = get_models_base_dir(models_dir)
+    fingerprint = []
+    for asset in ASSETS:
+        target = base / asset["target"]
+        files = sorted(target.rglob("*")) if asset["is_zip"] else [target]
+        for path in files:
+            if path.is_file():
+                stat = path.stat()
+                fingerprint.append([path.relative_to(base).as_posix(), stat.st_size, stat.st_mtime_ns])
+    return sorted(fingerprint)
+
+
 def ensure_models_downloaded(models_base_dir: Path) -> None:
     """Ensure required model assets exist under models_base_dir.
 
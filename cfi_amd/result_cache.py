@@ -0,0 +1,179 @@
+"""
+Persistent cache of processing results, keyed by the decoded pixel data and the configuration.
+
+Duplicate images (copies, or re-exports with identical pixel data, e.g. lossless formats) are processed
+once: a hit returns the bounds, coordinates, ETDRS summaries and the (uint8 quantised) model space outputs.
+
+Several processes (e.g. the worker processes of cfi_amd.main) can share the folder: each keeps its own index,
+which is read again from the folder when it exceeds the size limit or after writing 5% of the limit.
+The size limit applies to the folder, it can be exceeded by up to 5% for each process.
+
+Classes:
+- ResultCache: folder with one npz file per entry, size-bounded with LRU eviction.
+"""
+
+import hashlib
+import io
+import json
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from . import __version__
+from .ensemble import ProcessResult
+from .utils.cfi_bounds import CFIBounds
+from .utils.report import NumpyEncoder
+from .utils.transformation import ProjectiveTransform
+from .utils.utils import get_image_hash
+
+
+class ResultCache:
+
+    def __init__(self, folder, max_bytes=10 * 1024**3):
+        '''
+        folder: cache folder, entries are kept between runs
+        max_bytes: maximum total size of the entries, least recently used entries are removed
+        '''
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self.scan()
+
+    def scan(self):
+        '''
+        Reads the index from the folder: the entries by modification time (set on each access),
+        least recently used first. Includes the entries of other processes using the folder.
+        '''
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(f'{self.folder}/{name}')
+                except FileNotFoundError:
+                    # removed by another process
+                    continue
+                entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        with self.lock:
+            self.entries = OrderedDict(
+                (key, size) for _, key, size in sorted(entries))
+            self.total_bytes = sum(self.entries.values())
+            # written by this process since the scan, entries of other processes are not counted
+            self.bytes_since_scan = 0
+
+    @staticmethod
+    def get_key(image, config, image_hash=None):
+        '''
+        Hash of the pixel data and config (json serialisable dict with all settings
+        that change the results, e.g. Processor.mode and thresholds)
+        image_hash: optional utils.get_image_hash of image, if computed before
+        '''
+        h = hashlib.blake2b(digest_size=20)
+        h.update(json.dumps({
+            'version': __version__,
+            'config': config,
+        }, sort_keys=True).encode())
+        h.update((image_hash or get_image_hash(image)).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return f'{self.folder}/{key}.npz'
+
+    def get(self, key, image):
+        '''
+        Returns:
+        - (ProcessResult, coords, summaries) or None if key is not in the cache
+        '''
+        with self.lock:
+            if key not in self.entries:
+                # written by another process
+                try:
+                    self.entries[key] = os.path.getsize(self.path(key))
+                except OSError:
+                    return None
+                self.total_bytes += self.entries[key]
+            self.entries.move_to_end(key)
+        try:
+            with np.load(self.path(key)) as f:
+                data = dict(f)
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            # evicted by another process
+            self.remove(key)
+            return None
+        except Exception as e:
+            print(f'Error reading cache entry {key}: {e}')
+            self.remove(key)
+            return None
+
+        meta = json.loads(data.pop('meta').tobytes())
+        bounds = CFIBounds.from_dict(image, meta['bounds'])
+        transform = ProjectiveTransform.from_dict(meta['transform'])
+        result = ProcessResult(bounds, transform, data)
+        # maps are stored as uint8
+        result.quantized = True
+        coords = {k: np.array(v) for k, v in meta['coords'].items()}
+        return result, coords, meta['summaries']
+
+    def put(self, key, result, coords, summaries):
+        maps = {
+            feature: result.maps[feature] if result.quantized
+            else np.round(np.clip(result.maps[feature], 0, 1) * 255).astype(np.uint8)
+            for feature in result.maps
+        }
+        meta = {
+            'bounds': result.bounds.to_dict(),
+            'transform': result.transform.to_dict(),
+            'coords': {k: np.asarray(v).tolist() for k, v in coords.items()},
+            'summaries': summaries,
+        }
+        stream = io.BytesIO()
+        np.savez_compressed(
+            stream, meta=np.frombuffer(json.dumps(meta, cls=NumpyEncoder).encode(), dtype=np.uint8), **maps)
+        data = stream.getvalue()
+
+        # write to a temporary file first, readers never see partial entries
+        # (unique for each process and thread)
+        tmp_path = f'{self.path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path(key))
+
+        with self.lock:
+            self.total_bytes += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            self.bytes_since_scan += len(data)
+        self.evict()
+
+    def remove(self, key):
+        with self.lock:
+            self.total_bytes -= self.entries.pop(key, 0)
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        '''
+        Removes the least recently used entries if the folder exceeds max_bytes, down to 90%
+        of max_bytes, so the folder is not scanned again on each put
+        '''
+        if self.total_bytes <= self.max_bytes and self.bytes_since_scan <= 0.05 * self.max_bytes:
+            return
+        # other processes may have added, used or removed entries
+        self.scan()
+        if self.total_bytes <= self.max_bytes:
+            return
+        while True:
+            with self.lock:
+                if self.total_bytes <= 0.9 * self.max_bytes or len(self.entries) <= 1:
+                    return
+                key = next(iter(self.entries))
+            self.remove(key)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
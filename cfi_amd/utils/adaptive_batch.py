@@ -0,0 +1,116 @@
+"""
+Adaptive batch size for model inference: on allocation failures the batch is halved and retried,
+after a number of successful batches it grows back (one image at a time) to the requested size.
+
+The smallest failing batch size of each device is kept in a history file (batch_history.json
+in the user cache directory), so later runs start at a safe size.
+Failures that kill the process (e.g. the Linux OOM killer) can not be caught.
+
+Classes:
+- AdaptiveBatchSize
+"""
+
+import json
+import os
+from pathlib import Path
+
+from ..resources import default_models_dir
+
+
+def default_history_path():
+    return default_models_dir().parent / 'batch_history.json'
+
+
+def is_out_of_memory(e):
+    # torch raises RuntimeError (torch.cuda.OutOfMemoryError is a subclass), numpy MemoryError
+    if isinstance(e, MemoryError):
+        return True
+    if isinstance(e, RuntimeError):
+        message = str(e).lower()
+        return any(m in message for m in ('out of memory', "can't allocate memory", 'failed to allocate'))
+    return False
+
+
+class AdaptiveBatchSize:
+
+    def __init__(self, device_key, grow_after=4, history_path=None):
+        '''
+        device_key: name of the device in the history (e.g. 'cuda:NVIDIA A100' or 'cpu:64')
+        grow_after: number of successful batches before the batch size is increased
+        history_path: json file with the history of all devices (default: user cache directory)
+        '''
+        self.device_key = device_key
+        self.grow_after = grow_after
+        self.history_path = Path(history_path or default_history_path())
+        self.min_failed = self.load_history().get(device_key, {}).get('min_failed')
+        self.size = None
+        self.successes = 0
+
+    def load_history(self):
+        try:
+            with open(self.history_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_history(self):
+        history = self.load_history()
+        if self.min_failed is None:
+            history.pop(self.device_key, None)
+        else:
+            history[self.device_key] = {'min_failed': self.min_failed}
+        try:
+            self.history_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.history_path.with_name(f'{self.history_path.name}.{os.getpid()}.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(history, f, indent=2)
+            tmp_path.replace(self.history_path)
+        except OSError as e:
+            print(f'Error saving batch size history: {e}')
+
+    def run(self, fn, items, on_failure=None):
+        '''
+        Calls fn on consecutive chunks of items (of at most self.size items) and returns
+        the concatenated results. fn returns a list with one result for each item.
+        On allocation failures on_failure is called (e.g. to release cached memory)
+        and the chunk is retried with half the size.
+        '''
+        requested = len(items)
+        if self.size is None:
+            # start below the smallest size that failed before
+            self.size = requested if self.min_failed is None else max(1, min(requested, self.min_failed // 2))
+
+        results = []
+        start = 0
+        while start < len(items):
+            size = min(self.size, len(items) - start)
+            try:
+                results += fn(items[start:start + size])
+            except Exception as e:
+                if size == 1 or not is_out_of_memory(e):
+                    raise
+                if on_failure is not None:
+                    on_failure()
+                self.failed(size)
+                continue
+            start += size
+            self.succeeded(size, requested)
+        return results
+
+    def failed(self, size):
+        self.size = max(1, size // 2)
+        self.successes = 0
+        print(f'Out of memory with batch size {size}, retrying with batch size {self.size}')
+        if self.min_failed is None or size < self.min_failed:
+            self.min_failed = size
+            self.save_history()
+
+    def succeeded(self, size, requested):
+        if self.min_failed is not None and size >= self.min_failed:
+            # the failure was transient (e.g. a busy co-tenant)
+            self.min_failed = size + 1
+            self.save_history()
+        self.successes += 1
+        if self.successes >= self.grow_after and self.size < requested:
+            self.size += 1
+            self.successes = 0
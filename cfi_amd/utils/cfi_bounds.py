@@ -5,9 +5,11 @@ Classes:
 - CFIBounds: Represents the bounds, including a circle and lines.
 """
 
-from functools import cached_property, lru_cache
-from scipy.ndimage import gaussian_filter
+import threading
+from collections import OrderedDict
+from functools import cached_property
 import numpy as np
+import cv2
 from .transformation import get_affine_transform
 from .utils import to_uint8
 
@@ -37,6 +39,7 @@ class CFIBounds:
         self.cx = cx
         self.radius = radius
         self.lines = lines
+        self._crops = {}
         self.min_y = max(0, int(np.floor(cy - radius)))
         self.max_y = min(h, int(np.ceil(cy + radius)))
         self.min_x = max(0, int(np.floor(cx - radius)))
@@ -111,6 +114,8 @@ class CFIBounds:
             False: contrast enhance (default)
         '''
 
+        from scipy.ndimage import gaussian_filter
+
         ce_resolution = 256
         T = self.get_cropping_transform(ce_resolution)
         bounds_warped = self.warp(T)
@@ -136,6 +141,8 @@ class CFIBounds:
             By default, sigma is set to 0.05 times the radius
 
         '''
+        from scipy.ndimage import gaussian_filter
+
         if sigma is None:
             sigma = 0.05 * self.radius
         image = self.mirrored_image / 255
@@ -159,7 +166,6 @@ class CFIBounds:
         mask[:, self.max_x-d:] = False
         return mask
 
-    @lru_cache(maxsize=1)
     def get_coordinates(self, shrink_ratio=0.01):
         '''
         Args:
@@ -179,52 +185,25 @@ class CFIBounds:
         r_squared_norm = dx_norm**2 + dy_norm**2
         return dx, dy, r_squared_norm
 
-    def make_mirrored_image(self, shrink_ratio=0.01):
+    def make_mirrored_image(self, shrink_ratio=0.01, image=None):
         """
         mirrors pixels around the box and circle defined by bounds
         Can be used in combination with contrast_enhance to avoid the bright boundary around the rim
-        """
-
-        cy, cx = self.cy, self.cx
-        h, w = self.h, self.w
 
-        # start with a copy of the original image
-        result = np.copy(self.image)
+        The reflection is a remap table (see get_mirror_maps) that is cached per geometry,
+        so all channels and repeated calls with the same bounds share it.
+        Args:
+        - image: image to mirror (default: self.image), any number of channels
+        """
+        if image is None:
+            image = self.image
 
         # shrink by d pixels (to avoid artifacts at the boundary)
         d = int(np.round(shrink_ratio * self.radius))
-        min_y, max_y = self.min_y + d, self.max_y - d
-        min_x, max_x = self.min_x + d, self.max_x - d
-
-        # below min_y mirrored to above min_y
-        result[:min_y] = result[2 * min_y - 1: min_y - 1: -1]
-        # above max_y mirrored to below max_y
-        result[max_y:] = result[max_y: 2 * max_y - h: -1]
-
-        # left of min_x mirrored to right of min_x
-        result[:, :min_x] = result[:, 2 * min_x - 1: min_x - 1: -1]
-        # right of max_x mirrored to left of max_x
-        result[:, max_x:] = result[:, max_x: 2 * max_x - w: -1]
-
-        dx, dy, r_squared_norm = self.get_coordinates(shrink_ratio)
-
-        # pixels outside the circle
-        mask_outside = r_squared_norm > 1
-        y0, x0 = np.where(mask_outside)
-
-        # scale factor to be applied to reflect coordinates in circle outline
-        scale = 1 / r_squared_norm[mask_outside]
-
-        # round to nearest pixel
-        x1 = np.round(cx + dx[0, x0] * scale).astype(int)
-        y1 = np.round(cy + dy[y0, 0] * scale).astype(int)
-        x1 = np.clip(x1, 0, w - 1)
-        y1 = np.clip(y1, 0, h - 1)
-
-        # assing pixel values outside the circle their mirrored values
-        result[y0, x0] = result[y1, x1]
-
-        return result
+        maps = get_mirror_maps(
+            self.h, self.w, self.cx, self.cy, (1 - shrink_ratio) * self.radius,
+            self.min_y + d, self.max_y - d, self.min_x + d, self.max_x - d)
+        return remap(image, maps)
 
     def get_cropping_transform(self, target_diameter, patch_size=None):
         '''
@@ -237,16 +216,41 @@ class CFIBounds:
         center = self.cy, self.cx
         return get_affine_transform(in_size, patch_size, scale=scale, center=center)
 
-    def warp(self, transform):
+    def warp(self, transform, warp_image=True):
+        '''
+        Bounds in the space of transform
+        warp_image: if False, only the geometry is warped (image has 0 channels)
+        '''
         cx_warped, cy_warped = transform.apply([[self.cx, self.cy]])[0]
         radius_warped = self.radius * transform.scale
-        image_warped = transform.warp(self.image)
+        if warp_image:
+            image_warped = transform.warp(self.image)
+        else:
+            h, w = transform.out_size
+            image_warped = np.empty((int(np.ceil(h)), int(np.ceil(w)), 0), dtype=np.uint8)
         lines_warped = {k: transform.apply(v) for k, v in self.lines.items()}
         return CFIBounds(image_warped, cx_warped, cy_warped, radius_warped, lines_warped)
 
     def crop(self, target_diameter):
-        T = self.get_cropping_transform(target_diameter)
-        return T, self.warp(T)
+        '''
+        Warps the raw image to a target_diameter x target_diameter crop around the bounds.
+
+        The derived images of the returned bounds (contrast_enhanced_*, mirrored_image)
+        are computed in crop space, so preprocessing cost does not depend on the
+        resolution of the original image.
+        Crops are cached per target_diameter, so the segmentation (1024) and
+        landmark (512) inputs can share the same bounds without warping twice.
+        '''
+        if target_diameter not in self._crops:
+            T = self.get_cropping_transform(target_diameter)
+            self._crops[target_diameter] = T, self.warp(T)
+        return self._crops[target_diameter]
+
+    def release_crop(self, target_diameter):
+        '''
+        Removes a cached crop (see crop), releasing its image and derived images
+        '''
+        self._crops.pop(target_diameter, None)
 
     def _repr_markdown_(self):
         result = f"""
@@ -327,6 +331,102 @@ def line_circle_intersection(P0, P1, C, r):
         return [P0 + ti*d for ti in t]
 
 
+# total size of the remap tables kept in memory (one per image geometry, least recently used are removed):
+# the tables of the model crops (1024 and 512 px) take 4 MB and 1 MB, those of full size images
+# (e.g. 48 MB for 4000 x 3000) are mostly larger than the limit and not kept
+MIRROR_MAPS_CACHE_BYTES = 32 * 1024**2
+
+_mirror_maps = OrderedDict()
+_mirror_maps_lock = threading.Lock()
+
+
+def get_mirror_maps(h, w, cx, cy, r, min_y, max_y, min_x, max_x):
+    '''
+    make_mirror_maps, cached (see MIRROR_MAPS_CACHE_BYTES)
+    '''
+    key = h, w, cx, cy, r, min_y, max_y, min_x, max_x
+    with _mirror_maps_lock:
+        maps = _mirror_maps.get(key)
+        if maps is not None:
+            _mirror_maps.move_to_end(key)
+            return maps
+
+    maps = make_mirror_maps(*key)
+    if maps.nbytes <= MIRROR_MAPS_CACHE_BYTES:
+        with _mirror_maps_lock:
+            _mirror_maps[key] = maps
+            total = sum(m.nbytes for m in _mirror_maps.values())
+            while total > MIRROR_MAPS_CACHE_BYTES:
+                _, removed = _mirror_maps.popitem(last=False)
+                total -= removed.nbytes
+    return maps
+
+
+def make_mirror_maps(h, w, cx, cy, r, min_y, max_y, min_x, max_x):
+    '''
+    Remap table that mirrors pixels around a box and circle:
+    first in the box (min_y, max_y, min_x, max_x), then in the circle outline (cx, cy, r)
+
+    Returns:
+    - (h, w, 2) array with the (x, y) source pixel of each pixel (for cv2.remap)
+    '''
+    # reflections in the box, applied to the row and column indices
+    rows = np.arange(h)
+    # below min_y mirrored to above min_y
+    rows[:min_y] = rows[2 * min_y - 1: min_y - 1: -1]
+    # above max_y mirrored to below max_y
+    rows[max_y:] = rows[max_y: 2 * max_y - h: -1]
+    cols = np.arange(w)
+    # left of min_x mirrored to right of min_x
+    cols[:min_x] = cols[2 * min_x - 1: min_x - 1: -1]
+    # right of max_x mirrored to left of max_x
+    cols[max_x:] = cols[max_x: 2 * max_x - w: -1]
+
+    dx = np.arange(w)[None, :] - cx
+    dy = np.arange(h)[:, None] - cy
+    r_squared_norm = (dx / r)**2 + (dy / r)**2
+
+    # scale factor to reflect coordinates outside the circle in the circle outline
+    scale = 1 / np.maximum(r_squared_norm, 1)
+    del r_squared_norm
+
+    # round to nearest pixel
+    dtype = np.int16 if max(h, w) < 2**15 else np.float32
+    maps = np.empty((h, w, 2), dtype=dtype)
+    x1 = np.clip(np.round(cx + dx * scale), 0, w - 1).astype(int)
+    maps[..., 0] = cols[x1]
+    del x1
+    y1 = np.clip(np.round(cy + dy * scale), 0, h - 1).astype(int)
+    maps[..., 1] = rows[y1]
+    del y1, scale
+
+    maps.setflags(write=False)
+    return maps
+
+
+def remap(image, maps):
+    '''
+    Applies a remap table from get_mirror_maps (nearest neighbour) to an image
+    with any number of channels
+    '''
+    image_in = image.astype(np.uint8) if image.dtype == bool else image
+    if image.ndim == 3 and image.shape[2] > 4:
+        # cv2.remap supports up to 4 channels
+        result = np.concatenate([
+            remap(image_in[:, :, i:i + 4], maps)
+            for i in range(0, image.shape[2], 4)
+        ], axis=2)
+    else:
+        if maps.dtype == np.int16:
+            map_x, map_y = maps, None
+        else:
+            map_x, map_y = np.ascontiguousarray(maps[..., 0]), np.ascontiguousarray(maps[..., 1])
+        result = cv2.remap(image_in, map_x, map_y, cv2.INTER_NEAREST)
+        if image.ndim == 3 and result.ndim == 2:
+            result = result[:, :, None]
+    return result.astype(bool) if image.dtype == bool else result
+
+
 def unsharp_masking(image, blurred, contrast_factor=4, sharpen=False):
     if sharpen:
         return np.clip(contrast_factor * (image - blurred) + image, 0, 1)
@@ -1,5 +1,5 @@
 import numpy as np
-from functools import cached_property
+from functools import cached_property, lru_cache
 from skimage import measure
 import uuid
 
@@ -14,7 +14,7 @@ class ETDRS_masks:
     quadrants = 'superior_grid', 'nasal_grid', 'inferior_grid', 'temporal_grid'
     all_fields = tuple([*subfields_9, *rings_3, *quadrants, 'grid', 'total'])
 
-    def __init__(self, h, w, fovea_x, fovea_y, resolution, laterality):
+    def __init__(self, h, w, fovea_x, fovea_y, resolution, laterality, template_step=None):
         '''
         h: height of the image
         w: width of the image
@@ -22,6 +22,9 @@ class ETDRS_masks:
         fovea_y: y coordinate of the fovea
         resolution: resolution of the image in mm/pix
         laterality: laterality of the eye, 'R' or 'L'
+        template_step: if set, the grid is cut from a cached template (see get_template),
+            with the grid radius rounded to a multiple of template_step pixels
+            and the fovea rounded to the nearest pixel. Areas still use resolution.
         '''
         self.h = h
         self.w = w
@@ -30,6 +33,7 @@ class ETDRS_masks:
 
         self.resolution = resolution
         self.laterality = laterality
+        self.template_step = template_step
 
     def calculate_area(self, binary_image):
         return float(binary_image.sum() * self.resolution ** 2)
@@ -38,17 +42,133 @@ class ETDRS_masks:
         return int(np.max(measure.label(binary_image)))
 
     def get_summary(self, binary_image, fields, include_area=True, include_count=True):
-        masked_images = {
-            field: getattr(self, field) & binary_image
-            for field in fields
-        }
+        '''
+        Area (in mm²) and count (number of connected components) of binary_image in each field.
+        As if each field was labelled separately: a connected component split by a field
+        boundary counts once in each field, and in a field it is split into more components
+        if the field cuts it into parts.
+
+        Fields in the grid are computed on the crop of binary_image to roi, which is labelled
+        once with connectivity restricted to each region of label_map.
+        Fields are unions of regions: areas are sums of per-region pixel counts and counts
+        are connected components of the graph of adjacent region components within the field.
+        '''
+        field_regions = self.field_regions
+        binary_roi = binary_image[self.roi]
+
+        if include_area:
+            region_areas = np.bincount(
+                self.label_map[binary_roi], minlength=self.n_regions)
+        if include_count:
+            _, region_of_component, edges = label_regions(
+                binary_roi, self.label_map)
+
         result = {}
-        for field, masked_image in masked_images.items():
+        for field in fields:
+            if field not in field_regions:
+                # not a union of regions in the grid, use the full image
+                masked_image = binary_image if field == 'total' else getattr(self, field) & binary_image
+                if include_area:
+                    result[f'{field}_area'] = self.calculate_area(masked_image)
+                if include_count:
+                    result[f'{field}_count'] = self.calculate_count(masked_image)
+                continue
+
+            regions = field_regions[field]
             if include_area:
-                result[f'{field}_area'] = self.calculate_area(masked_image)
+                area = region_areas[regions].sum()
+                result[f'{field}_area'] = float(area * self.resolution ** 2)
             if include_count:
-                result[f'{field}_count'] = self.calculate_count(masked_image)
+                result[f'{field}_count'] = count_components(
+                    region_of_component, edges, regions)
+
+        return result
+
+    '''regions'''
+    # fields in the grid are unions of regions: ring x quadrant
+    rings_4 = 'center', 'inner', 'outer', 'outside'
+    quadrants_4 = 'superior', 'right', 'inferior', 'left'
+    n_regions = len(rings_4) * len(quadrants_4)
+
+    @cached_property
+    def roi(self):
+        '''
+        Slices of the bounding box of the grid (3 mm around the fovea), clipped to the image
+        '''
+        if self.template_step is None:
+            r = 3 / self.resolution
+            y0, y1 = np.floor(self.fovea_y - r), np.ceil(self.fovea_y + r) + 1
+            x0, x1 = np.floor(self.fovea_x - r), np.ceil(self.fovea_x + r) + 1
+        else:
+            c = len(self.template) // 2
+            y0, y1 = self.template_y - c, self.template_y + c + 1
+            x0, x1 = self.template_x - c, self.template_x + c + 1
+        y0, y1 = np.clip([y0, y1], 0, self.h).astype(int)
+        x0, x1 = np.clip([x0, x1], 0, self.w).astype(int)
+        return np.s_[y0:y1, x0:x1]
+
+    @cached_property
+    def label_map(self):
+        '''
+        Region index of each pixel in roi: 4 * ring + quadrant
+        (see rings_4 and quadrants_4, same boundaries as the masks below)
+        '''
+        rows, cols = self.roi
+        if self.template_step is not None:
+            # paste the template at the (rounded) fovea
+            c = len(self.template) // 2
+            return self.template[
+                rows.start - self.template_y + c: rows.stop - self.template_y + c,
+                cols.start - self.template_x + c: cols.stop - self.template_x + c]
+
+        dy = np.arange(rows.start, rows.stop)[:, None] - self.fovea_y
+        dx = np.arange(cols.start, cols.stop)[None, :] - self.fovea_x
+        return make_label_map(dx, dy, self.resolution)
+
+    @cached_property
+    def template(self):
+        radius = self.template_step * max(1, round(3 / (self.resolution * self.template_step)))
+        return get_template(radius)
+
+    @property
+    def template_x(self):
+        return int(np.round(self.fovea_x))
+
+    @property
+    def template_y(self):
+        return int(np.round(self.fovea_y))
 
+    @cached_property
+    def field_regions(self):
+        '''
+        Region indices (see label_map) that make up each field in the grid
+        '''
+        def regions(rings, quadrants):
+            return np.array([
+                4 * self.rings_4.index(ring) + self.quadrants_4.index(quadrant)
+                for ring in rings
+                for quadrant in quadrants
+            ])
+
+        nasal, temporal = ('right', 'left') if self.laterality == 'R' else ('left', 'right')
+        quadrants = {
+            'superior': 'superior',
+            'nasal': nasal,
+            'inferior': 'inferior',
+            'temporal': temporal,
+        }
+        grid = self.rings_3
+        result = {
+            'grid': regions(grid, self.quadrants_4),
+            'CSF': regions(['center'], self.quadrants_4),
+        }
+        for ring in grid:
+            result[ring] = regions([ring], self.quadrants_4)
+        for name, quadrant in quadrants.items():
+            result[f'{name}_grid'] = regions(grid, [quadrant])
+            for ring in ('inner', 'outer'):
+                subfield = f'{name[0].upper()}{ring[0].upper()}M'
+                result[subfield] = regions([ring], [quadrant])
         return result
 
     @cached_property
@@ -250,3 +370,89 @@ class ETDRS_masks:
 
     def _repr_svg_(self):
         return self.create_svg({k: k for k in self.subfields_9})
+
+
+def make_label_map(dx, dy, resolution):
+    '''
+    Region index (4 * ring + quadrant, see ETDRS_masks.label_map) for offsets dx, dy
+    to the fovea (in pixels), with resolution in mm/pix
+    '''
+    d = resolution * np.sqrt(dx * dx + dy * dy)
+    ring = (d >= 0.5).astype(np.int8) + (d >= 1.5) + (d >= 3)
+    del d
+
+    theta = np.arctan2(dy, dx) / (2 * np.pi)
+    quadrant = np.full(theta.shape, 3, dtype=np.int8)
+    quadrant[(-3/8 < theta) & (theta <= -1/8)] = 0
+    quadrant[(-1/8 < theta) & (theta <= 1/8)] = 1
+    quadrant[(1/8 < theta) & (theta <= 3/8)] = 2
+    return 4 * ring + quadrant
+
+
+# number of ETDRS templates kept in memory
+TEMPLATE_CACHE_SIZE = 16
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def get_template(radius):
+    '''
+    Label map (see make_label_map) of a grid with radius (3 mm) in pixels,
+    with the fovea at the center pixel
+
+    Laterality is not part of the template: nasal/temporal are resolved in field_regions
+    '''
+    c = int(np.ceil(radius)) + 1
+    offsets = np.arange(-c, c + 1)
+    template = make_label_map(offsets[None, :], offsets[:, None], 3 / radius)
+    template.setflags(write=False)
+    return template
+
+
+def label_regions(binary_image, label_map):
+    '''
+    Labels binary_image once, only connecting pixels within the same region of label_map
+
+    Returns:
+    - labels: labelled image
+    - region_of_component: region index for each label (-1 for background)
+    - edges: (n, 2) array of labels of adjacent components (in different regions)
+    '''
+    labels = measure.label(np.where(binary_image, label_map + 1, 0))
+    region_of_component = np.full(labels.max(initial=0) + 1, -1)
+    region_of_component[labels[binary_image]] = label_map[binary_image]
+
+    # neighbours in 8-connectivity (same as measure.label)
+    pairs = [
+        (labels[:, :-1], labels[:, 1:]),
+        (labels[:-1, :], labels[1:, :]),
+        (labels[:-1, :-1], labels[1:, 1:]),
+        (labels[:-1, 1:], labels[1:, :-1]),
+    ]
+    edges = [
+        np.stack([a[m], b[m]], axis=1)
+        for a, b in pairs
+        for m in [(a != b) & (a > 0) & (b > 0)]
+    ]
+    edges = np.unique(np.concatenate(edges), axis=0)
+    return labels, region_of_component, edges
+
+
+def count_components(region_of_component, edges, regions):
+    '''
+    Number of connected components of the union of regions,
+    given the components per region and their adjacency
+    '''
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    in_field = np.isin(region_of_component, regions)
+    n_components = int(in_field.sum())
+    if n_components == 0:
+        return 0
+    edges = edges[in_field[edges[:, 0]] & in_field[edges[:, 1]]]
+    n = len(region_of_component)
+    graph = coo_matrix(
+        (np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(n, n))
+    n_graph_components, _ = connected_components(graph, directed=False)
+    # components outside the field (and background) are isolated nodes in the graph
+    return int(n_graph_components - (n - n_components))
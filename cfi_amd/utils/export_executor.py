@@ -0,0 +1,52 @@
+"""
+Module containing the ExportExecutor class, running export jobs (image encoding, file writes)
+on worker threads while the next image is processed.
+"""
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class ExportExecutor:
+
+    def __init__(self, workers=2, max_pending=4):
+        '''
+        Args:
+        - workers: number of worker threads, 0 runs the jobs synchronously in submit
+        - max_pending: maximum number of queued or running jobs,
+            submit blocks until a job finishes (keeps memory bounded)
+        '''
+        self.executor = ThreadPoolExecutor(workers) if workers > 0 else None
+        self.slots = threading.BoundedSemaphore(max(1, max_pending))
+
+    def submit(self, fn, *args, **kwargs):
+        '''
+        Returns a Future, exceptions in fn are raised by future.result()
+        '''
+        if self.executor is None:
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def shutdown(self):
+        # waits for all jobs to finish
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
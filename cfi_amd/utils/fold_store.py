@@ -0,0 +1,62 @@
+"""
+Storage of the output of each model of the ensembles (the folds), so the ensembles can be
+re-combined with another mode or other thresholds without running the models again.
+
+The folds are stored in model space (the 1024 x 1024 crop of the bounds) as uint8 or float16,
+with the bounds, the cropping transform and the landmark coordinates (one npz per image).
+
+Functions:
+- save_folds / load_folds
+"""
+
+import json
+import numpy as np
+
+DTYPES = 'uint8', 'float16'
+
+
+def save_folds(path, folds, bounds, transform, coords, dtype='uint8'):
+    '''
+    Args:
+    - folds: dict with an array (n_models, 1024, 1024) for each feature (see Processor.predict_folds)
+    - bounds: CFIBounds of the original image
+    - transform: ProjectiveTransform from the original image to model space
+    - coords: dict with the fovea and disc edge coordinates
+    - dtype: 'uint8' (quantised probabilities) or 'float16'
+    '''
+    if dtype == 'uint8':
+        arrays = {
+            feature: np.round(np.clip(y, 0, 1) * 255).astype(np.uint8)
+            for feature, y in folds.items()
+        }
+    elif dtype == 'float16':
+        arrays = {feature: y.astype(np.float16) for feature, y in folds.items()}
+    else:
+        raise ValueError(f'Unknown dtype: {dtype}')
+
+    meta = {
+        'bounds': bounds.to_dict(),
+        'transform': transform.to_dict(),
+        'coords': {k: np.asarray(v).tolist() for k, v in coords.items()},
+        'features': list(folds),
+    }
+    meta = np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)
+    np.savez_compressed(path, meta=meta, **arrays)
+
+
+def load_folds(path):
+    '''
+    Returns:
+    - folds: dict with a float32 array (n_models, 1024, 1024) for each feature
+    - meta: dict with 'bounds', 'transform' and 'coords' (as stored by to_dict)
+    '''
+    with np.load(path) as f:
+        meta = json.loads(f['meta'].tobytes())
+        folds = {}
+        for feature in meta['features']:
+            y = f[feature]
+            if y.dtype == np.uint8:
+                folds[feature] = y.astype(np.float32) / 255
+            else:
+                folds[feature] = y.astype(np.float32)
+    return folds, meta
@@ -0,0 +1,106 @@
+"""
+Early gradability gate: cheap checks (at 256 px) before the models run, to skip images that are not
+usable colour fundus photographs (e.g. other image types, external eye photographs, heavily over-
+or underexposed images).
+
+The checks use the signals of the bounds detection (see mask_extraction.get_cfi_bounds_batch)
+and intensity statistics within the bounds. An image fails the gate with one or more reason codes:
+- no_fundus_edge: few points of the detected edge lie on a circle (circle_fraction)
+- low_edge_contrast: weak step in intensity across the detected edge (edge_contrast)
+- radius_out_of_range: fitted radius relative to half the smallest image side (radius_fraction)
+- no_field_contrast: the field is not darker outside the bounds (field_contrast),
+  e.g. a photograph without the dark background of a fundus image
+- underexposed / overexposed: mean intensity within the bounds (mean_intensity)
+  or fraction of saturated pixels (saturated_fraction)
+
+The default thresholds are permissive, they are meant to catch junk rather than borderline quality.
+
+Functions:
+- check_gradability_batch
+"""
+
+import numpy as np
+
+from .mask_extraction import get_cfi_bounds_batch
+from .utils import rescale
+
+THUMBNAIL_SIZE = 256
+
+default_thresholds = {
+    'min_circle_fraction': 0.15,
+    'min_edge_contrast': 0.15,
+    'min_radius_fraction': 0.5,
+    'max_radius_fraction': 2.0,
+    'min_field_contrast': 0.5,
+    'min_mean_intensity': 0.05,
+    'max_mean_intensity': 0.75,
+    'max_saturated_fraction': 0.25,
+}
+
+
+def get_intensity_statistics(image, bounds):
+    '''
+    Intensity statistics (in [0, 1]) of image within and outside the bounds, on a thumbnail
+
+    Returns:
+    - dict with radius_fraction, mean_intensity, saturated_fraction and field_contrast
+      (None if the bounds cover the whole image)
+    '''
+    h, w = image.shape[:2]
+    T, thumbnail = rescale(image, resolution=THUMBNAIL_SIZE)
+    # pixels of the image (not the padding of the thumbnail)
+    valid = T.warp(np.ones((h, w), dtype=np.uint8)) > 0
+    inside = bounds.warp(T, warp_image=False).mask & valid
+    outside = valid & ~inside
+
+    intensity = thumbnail.mean(axis=2) / 255 if thumbnail.ndim == 3 else thumbnail / 255
+    mean_inside = float(intensity[inside].mean()) if inside.any() else 0.
+    field_contrast = None
+    if outside.sum() > 0.01 * valid.sum() and mean_inside > 0:
+        field_contrast = float((mean_inside - intensity[outside].mean()) / mean_inside)
+    saturated = thumbnail.min(axis=2) >= 250 if thumbnail.ndim == 3 else thumbnail >= 250
+    return {
+        'radius_fraction': float(bounds.radius / (0.5 * min(h, w))),
+        'mean_intensity': mean_inside,
+        'saturated_fraction': float(saturated[inside].mean()) if inside.any() else 0.,
+        'field_contrast': field_contrast,
+    }
+
+
+def get_reasons(quality, thresholds=default_thresholds):
+    '''
+    Returns:
+    - list of reason codes (empty if the image passes the gate)
+    '''
+    reasons = []
+    if quality['circle_fraction'] < thresholds['min_circle_fraction']:
+        reasons.append('no_fundus_edge')
+    if quality['edge_contrast'] < thresholds['min_edge_contrast']:
+        reasons.append('low_edge_contrast')
+    if not thresholds['min_radius_fraction'] <= quality['radius_fraction'] <= thresholds['max_radius_fraction']:
+        reasons.append('radius_out_of_range')
+    if quality['field_contrast'] is not None and quality['field_contrast'] < thresholds['min_field_contrast']:
+        reasons.append('no_field_contrast')
+    if quality['mean_intensity'] < thresholds['min_mean_intensity']:
+        reasons.append('underexposed')
+    if (quality['mean_intensity'] > thresholds['max_mean_intensity']
+            or quality['saturated_fraction'] > thresholds['max_saturated_fraction']):
+        reasons.append('overexposed')
+    return reasons
+
+
+def check_gradability_batch(images, thresholds=default_thresholds):
+    '''
+    Bounds detection and the gradability gate for a list of images
+
+    Returns:
+    - list of CFIBounds (one for each image, can be passed to the processors)
+    - list of dicts with the signals and 'reasons' (the reason codes, empty if the image passes)
+    '''
+    bounds, signals = get_cfi_bounds_batch(images, return_signals=True)
+    qualities = []
+    for image, b, s in zip(images, bounds, signals):
+        quality = {**s, **get_intensity_statistics(image, b)}
+        quality['reasons'] = get_reasons(quality, thresholds)
+        qualities.append(quality)
+    return bounds, qualities
@@ -0,0 +1,112 @@
+"""
+Vector export of segmentation masks: outlines of the connected components (lesions) as GeoJSON polygons.
+
+Coordinates are (x, y) in the original image, along the pixel edges: pixel (x, y) covers the square
+from (x, y) to (x + 1, y + 1), so the polygon area equals the number of pixels (area_pixels).
+Outlines are traced with cv2.findContours, so components are 8-connected
+(same as skimage.measure.label used for the counts in ETDRS_masks).
+Rings follow RFC 7946: exterior rings are counter-clockwise and holes clockwise (with the y axis up,
+as GeoJSON viewers draw them; shown as an image, with y down, the orientation is mirrored).
+"""
+
+import json
+import numpy as np
+import cv2
+
+
+def signed_area(points):
+    # shoelace formula, positive for counter-clockwise rings (y axis up)
+    x, y = np.asarray(points, dtype=np.float64).T
+    return 0.5 * float(np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y))
+
+
+def ring(contour, offset, exterior):
+    '''
+    GeoJSON ring of a contour traced on the mask upscaled 2x (see get_lesion_polygons)
+    '''
+    # a foreground pixel x covers 2x and 2x + 1 of the upscaled mask: border pixels at 2x lie on
+    # its left (or top) edge x, those at 2x + 1 on its right (or bottom) edge x + 1
+    points = (contour.reshape(-1, 2) + 1) // 2 + offset
+    # diagonal steps (8-connected pixels) map to repeated points
+    keep = np.any(points != np.roll(points, 1, axis=0), axis=1)
+    points = points[keep].tolist()
+    if (signed_area(points) > 0) != exterior:
+        points = points[::-1]
+    # GeoJSON rings are closed
+    return points + points[:1]
+
+
+def get_lesion_polygons(binary_image, resolution, bounds=None):
+    '''
+    Args:
+    - binary_image: full size binary mask
+    - resolution: resolution in mm/pix (for the area in mm²)
+    - bounds: optional CFIBounds, only the rectangle of the bounds is searched
+
+    Returns:
+    - list of GeoJSON features (one Polygon for each connected component, holes included)
+    '''
+    if bounds is None:
+        y0, x0 = 0, 0
+        crop = binary_image
+    else:
+        y0, x0 = bounds.min_y, bounds.min_x
+        crop = binary_image[y0:bounds.max_y, x0:bounds.max_x]
+    crop = np.ascontiguousarray(crop, dtype=np.uint8)
+
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(crop, connectivity=8)
+    # findContours follows the centres of the border pixels: traced at 2x, the border pixels lie
+    # on the pixel edges of crop (small lesions would otherwise give rings without area)
+    upscaled = cv2.resize(crop, (2 * crop.shape[1], 2 * crop.shape[0]), interpolation=cv2.INTER_NEAREST)
+    contours, hierarchy = cv2.findContours(upscaled, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    if len(contours) == 0:
+        return []
+    hierarchy = hierarchy[0]
+    offset = np.array([x0, y0])
+
+    features = []
+    for i, contour in enumerate(contours):
+        _, _, first_child, parent = hierarchy[i]
+        if parent != -1:
+            # hole, added to its outer contour
+            continue
+        rings = [ring(contour, offset, exterior=True)]
+        child = first_child
+        while child != -1:
+            rings.append(ring(contours[child], offset, exterior=False))
+            child = hierarchy[child][0]
+
+        x, y = contour[0, 0] // 2
+        area_pixels = int(stats[labels[y, x], cv2.CC_STAT_AREA])
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Polygon', 'coordinates': rings},
+            'properties': {
+                'area_pixels': area_pixels,
+                'area': area_pixels * resolution ** 2,
+            },
+        })
+    return features
+
+
+def export_lesion_polygons(path, feature_images, resolution, bounds=None):
+    '''
+    Writes the lesions of all features to one GeoJSON FeatureCollection
+    Each feature has properties: feature (name), area (mm²) and area_pixels
+
+    Args:
+    - feature_images: dict with the full size binary mask of each feature
+    '''
+    features = []
+    for feature_name, binary_image in feature_images.items():
+        for feature in get_lesion_polygons(binary_image, resolution, bounds):
+            feature['properties']['feature'] = feature_name
+            features.append(feature)
+
+    collection = {
+        'type': 'FeatureCollection',
+        'resolution': resolution,
+        'features': features,
+    }
+    with open(path, 'w') as f:
+        json.dump(collection, f, separators=(',', ':'))
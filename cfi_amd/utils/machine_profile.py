@@ -0,0 +1,56 @@
+"""
+Machine profile: the runner configuration (worker processes, torch threads, batch size)
+selected by cfi_amd.autotune, applied by cfi_amd.main to the arguments that are not set.
+"""
+
+import json
+import os
+from pathlib import Path
+
+from ..resources import default_models_dir
+
+profile_keys = 'workers', 'torch_threads', 'batch_size'
+
+
+def default_profile_path():
+    # next to the models in the user cache directory
+    return default_models_dir().parent / 'profile.json'
+
+
+def load_profile(path=None):
+    '''
+    Returns the profile (dict), or None if there is no profile
+    '''
+    path = Path(path or default_profile_path())
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_profile(profile, path=None):
+    path = Path(path or default_profile_path())
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(profile, f, indent=2)
+    tmp_path.replace(path)
+
+
+def apply_profile(args, profile):
+    '''
+    Sets the arguments in profile_keys that are None to the values of the profile.
+    The profile is only applied on the machine and device it was made for.
+    '''
+    if profile is None:
+        return
+    if profile.get('cpu_count') != os.cpu_count() or profile.get('device') != args.device_type:
+        print('Machine profile was made for another machine or device, not applied')
+        return
+    applied = {}
+    for key in profile_keys:
+        if getattr(args, key) is None and key in profile:
+            setattr(args, key, profile[key])
+            applied[key] = profile[key]
+    if applied:
+        print(f'Applied machine profile: {applied}')
@@ -1,7 +1,5 @@
 import numpy as np
 import cv2
-from scipy.ndimage import sobel
-from sklearn.linear_model import RANSACRegressor
 
 from .circle_fit import find_circle, circle_fit
 from .cfi_bounds import CFIBounds
@@ -39,46 +37,67 @@ SIN_TH = np.sin(th)
 
 def shortest_path(edge_image_horizontal):
     # vertical cut through polar representation of the edges
+    return shortest_path_batch(edge_image_horizontal[None])[0]
 
-    costs = np.copy(edge_image_horizontal)
-    resolution = costs.shape[0]
+
+def shortest_path_batch(edge_images_horizontal):
+    # vertical cuts through a stack (n, h, w) of polar representations of the edges
+
+    costs = np.copy(edge_images_horizontal)
+    n_images, resolution, _ = costs.shape
 
     # Initialize the path array with zeros
     path = np.zeros_like(costs, dtype=int)
 
     for y in range(1, resolution):
         # Add the distance cost to the cost array and get the minimum and its index over the columns
-        total_costs = costs[y - 1] + COST_DIST
-        min_costs = np.min(total_costs, axis=1)
-        min_indices = np.argmin(total_costs, axis=1)
-        costs[y] += min_costs
-        path[y] = min_indices
+        total_costs = costs[:, y - 1, None, :] + COST_DIST
+        min_indices = np.argmin(total_costs, axis=2)
+        min_costs = np.take_along_axis(total_costs, min_indices[..., None], axis=2)
+        costs[:, y] += min_costs[..., 0]
+        path[:, y] = min_indices
 
     # Find the pixel with the minimum cost in the last row
-    min_index = np.argmin(costs[-1])
+    min_index = np.argmin(costs[:, -1], axis=1)
 
     # Backtrack to get the path
     actual_path = [min_index]
+    images = np.arange(n_images)
     for i in range(resolution-2, -1, -1):
-        min_index = path[i+1, min_index]
+        min_index = path[images, i+1, min_index]
         actual_path.append(min_index)
 
     # Reverse the path to get it from top to bottom
-    return np.array(actual_path[::-1])
+    return np.array(actual_path[::-1]).T
 
 
 def get_edge_points(image):
+    xs, ys = get_edge_points_batch(image[None])
+    return xs[0], ys[0]
+
+
+def get_edge_points_batch(images, return_contrast=False):
+    # images: stack (n, RESOLUTION, RESOLUTION) of rescaled gray scale images
+    # return_contrast: also return the edge contrast of each image (see below)
+
     # convert to polar coordinates (with max radius MAX_R)
-    polar_image = cv2.linearPolar(
-        image, (CENTER, CENTER), MAX_R, cv2.WARP_FILL_OUTLIERS)
+    polar_images = np.array([
+        cv2.linearPolar(image, (CENTER, CENTER), MAX_R, cv2.WARP_FILL_OUTLIERS)
+        for image in images
+    ])
     # crop (assuming radius > MIN_R)
-    edge_region = polar_image[:, MIN_R:]
+    edge_regions = polar_images[:, :, MIN_R:]
+
+    from scipy.ndimage import correlate1d
 
-    # horizontal edge detection
-    gx = sobel(edge_region / edge_region.max(), 1)
+    # horizontal edge detection (sobel within each image, not across the stack)
+    # (black images have no edges)
+    edge_regions = edge_regions / np.maximum(edge_regions.max(axis=(1, 2), keepdims=True), 1e-12)
+    gx = correlate1d(edge_regions, [-1, 0, 1], axis=2)
+    gx = correlate1d(gx, [1, 2, 1], axis=1)
 
     # cut a line from top to bottom with least cost
-    p = shortest_path(gx)
+    p = shortest_path_batch(gx)
 
     # convert back to cartesian coordinates
     radii = MIN_R + p
@@ -86,12 +105,18 @@ def get_edge_points(image):
     xs = CENTER + r * COST_TH
     ys = CENTER + r * SIN_TH
 
-    # return list of points [n = RESOLUTION] on the edge of the ROI
+    # return arrays of points [n, RESOLUTION] on the edge of the ROI
+    if return_contrast:
+        # mean step in intensity across the edge (relative to the brightest pixel),
+        # sobel kernel [1, 2, 1] x [-1, 0, 1] gives 4 x the step
+        contrast = -np.take_along_axis(gx, p[..., None], axis=2)[..., 0].mean(axis=1) / 4
+        return xs, ys, contrast
     return xs, ys
 
 
 def find_line(pts_x, pts_y):
     # fit a line to the points using RANSAC
+    from sklearn.linear_model import RANSACRegressor
 
     ransac = RANSACRegressor(residual_threshold=INLIER_DIST_THRESHOLD)
     ransac.fit(pts_x.reshape(-1, 1), pts_y)
@@ -141,6 +166,13 @@ def get_mask(image):
 
     xs, ys = get_edge_points(image_scaled)
 
+    return fit_mask(xs, ys, T0)
+
+
+def fit_mask(xs, ys, T0):
+    # fit circle and lines to the edge points (at RESOLUTION)
+    # and transform back to the original image with T0
+
     try:
         radius, center, inliers = find_circle(
             xs, ys, MIN_R, MAX_R, inlier_dist_threshold=INLIER_DIST_THRESHOLD)
@@ -166,13 +198,54 @@ def get_mask(image):
     result['center'] = center
     result['radius'] = radius
 
-    return inverse_tranform(result, T0)
+    mask = inverse_tranform(result, T0)
+    # fraction of the edge points on the circle (used by utils.gradability)
+    mask['circle_fraction'] = float(circle_fraction)
+    return mask
 
 
-def get_cfi_bounds(image):
-    mask = get_mask(image)
+def make_cfi_bounds(image, mask):
     cx, cy = mask['center']
     radius = mask['radius']
     lines = {k: mask[k] for k in [
         'top', 'bottom', 'left', 'right'] if k in mask}
     return CFIBounds(image, cx, cy, radius, lines)
+
+
+def get_cfi_bounds(image):
+    return make_cfi_bounds(image, get_mask(image))
+
+
+def get_cfi_bounds_batch(images, return_signals=False):
+    '''
+    Bounds detection for a list of images (of any size)
+
+    The polar edge detection and shortest path run on the stack of rescaled images,
+    only the circle and line fits (RANSAC) run per image.
+    Uses a single process: for large sweeps, map chunks of images over a process pool.
+
+    Args:
+    - return_signals: also return the signals of the detection for each image (see utils.gradability):
+      circle_fraction (fraction of the edge points on the fitted circle)
+      and edge_contrast (step in intensity across the edge, relative to the brightest pixel)
+
+    Returns:
+    - list with a CFIBounds for each image
+    - (with return_signals) list with a dict of signals for each image
+    '''
+    if len(images) == 0:
+        return ([], []) if return_signals else []
+    transforms, images_scaled = zip(*(
+        rescale(get_gray_scale(image), resolution=RESOLUTION)
+        for image in images
+    ))
+    xs, ys, contrast = get_edge_points_batch(np.array(images_scaled), return_contrast=True)
+    masks = [fit_mask(x, y, T0) for T0, x, y in zip(transforms, xs, ys)]
+    bounds = [make_cfi_bounds(image, mask) for image, mask in zip(images, masks)]
+    if not return_signals:
+        return bounds
+    signals = [
+        {'circle_fraction': mask['circle_fraction'], 'edge_contrast': float(c)}
+        for mask, c in zip(masks, contrast)
+    ]
+    return bounds, signals
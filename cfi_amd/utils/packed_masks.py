@@ -0,0 +1,170 @@
+"""
+Compact storage of the segmentation masks of an image.
+
+All masks of an image are stored in one container (npz), cropped to the rectangle of the CFIBounds,
+as bit-packed binary masks or as uint8 quantised probabilities.
+Masks are assumed to be zero outside the rectangle (as in the output of Processor.process).
+
+Functions:
+- save_masks / load_masks: one container per image
+Classes:
+- MaskStore: cohort-level store, appending the containers of many images to a few chunk files
+"""
+
+import csv
+import io
+import os
+import threading
+import numpy as np
+
+# first bytes of a zstd frame
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+META_KEYS = 'shape', 'offset', 'crop_shape', 'probability'
+
+
+def pack_masks(masks, bounds, probability=False):
+    '''
+    Args:
+    - masks: dict with full size arrays (probability maps or binary masks) of the same shape
+    - bounds: CFIBounds, the masks are cropped to its rectangle
+    - probability: store uint8 quantised probabilities instead of binary masks (>= 0.5)
+
+    Returns:
+    - dict of arrays
+    '''
+    y0, y1 = bounds.min_y, bounds.max_y
+    x0, x1 = bounds.min_x, bounds.max_x
+    h, w = next(iter(masks.values())).shape[:2]
+    result = {
+        'shape': np.array([h, w]),
+        'offset': np.array([y0, x0]),
+        'crop_shape': np.array([y1 - y0, x1 - x0]),
+        'probability': np.array(probability),
+    }
+    for name, mask in masks.items():
+        crop = mask[y0:y1, x0:x1]
+        if probability:
+            result[name] = np.round(np.clip(crop, 0, 1) * 255).astype(np.uint8)
+        else:
+            result[name] = np.packbits(crop >= 0.5)
+    return result
+
+
+def unpack_masks(packed):
+    '''
+    Inverse of pack_masks
+
+    Returns:
+    - dict with full size arrays: bool masks, or float32 probabilities
+    '''
+    h, w = packed['shape']
+    y0, x0 = packed['offset']
+    crop_h, crop_w = packed['crop_shape']
+    probability = bool(packed['probability'])
+
+    result = {}
+    for name, data in packed.items():
+        if name in META_KEYS:
+            continue
+        if probability:
+            full = np.zeros((h, w), dtype=np.float32)
+            full[y0:y0 + crop_h, x0:x0 + crop_w] = data / np.float32(255)
+        else:
+            full = np.zeros((h, w), dtype=bool)
+            crop = np.unpackbits(data, count=crop_h * crop_w)
+            full[y0:y0 + crop_h, x0:x0 + crop_w] = crop.reshape(crop_h, crop_w)
+        result[name] = full
+    return result
+
+
+def to_bytes(packed, compression='deflate'):
+    '''
+    compression: 'deflate' (npz default), 'zstd' (requires the zstandard package) or None
+    '''
+    stream = io.BytesIO()
+    if compression == 'deflate':
+        np.savez_compressed(stream, **packed)
+    else:
+        np.savez(stream, **packed)
+    data = stream.getvalue()
+
+    if compression == 'zstd':
+        import zstandard
+        data = zstandard.ZstdCompressor().compress(data)
+    elif compression not in ('deflate', None):
+        raise ValueError(f'Unknown compression: {compression}')
+    return data
+
+
+def from_bytes(data):
+    if data[:4] == ZSTD_MAGIC:
+        import zstandard
+        data = zstandard.ZstdDecompressor().decompress(data)
+    with np.load(io.BytesIO(data)) as f:
+        return dict(f)
+
+
+def save_masks(path, masks, bounds, probability=False, compression='deflate'):
+    data = to_bytes(pack_masks(masks, bounds, probability), compression)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def load_masks(path):
+    with open(path, 'rb') as f:
+        return unpack_masks(from_bytes(f.read()))
+
+
+class MaskStore:
+    '''
+    Packed masks of many images, appended to chunk files of chunk_size images,
+    with an index (index.csv) of identifier, chunk, offset and length.
+    If an identifier is stored more than once, the last one is used.
+    '''
+
+    def __init__(self, folder, chunk_size=1024):
+        self.folder = folder
+        self.chunk_size = chunk_size
+        self.index_path = f'{folder}/index.csv'
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+        self.index = {}
+        self.n_records = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, newline='') as f:
+                for identifier, chunk, offset, length in csv.reader(f):
+                    self.index[identifier] = int(chunk), int(offset), int(length)
+                    self.n_records += 1
+
+    def chunk_path(self, chunk):
+        return f'{self.folder}/chunk_{chunk:05d}.bin'
+
+    def append(self, identifier, masks, bounds, probability=False, compression='deflate'):
+        data = to_bytes(pack_masks(masks, bounds, probability), compression)
+
+        # safe to call from several export threads
+        with self.lock:
+            chunk = self.n_records // self.chunk_size
+            with open(self.chunk_path(chunk), 'ab') as f:
+                offset = f.tell()
+                f.write(data)
+            with open(self.index_path, 'a', newline='') as f:
+                csv.writer(f).writerow([identifier, chunk, offset, len(data)])
+
+            self.index[str(identifier)] = chunk, offset, len(data)
+            self.n_records += 1
+
+    def read(self, identifier):
+        chunk, offset, length = self.index[str(identifier)]
+        with open(self.chunk_path(chunk), 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        return unpack_masks(from_bytes(data))
+
+    def __contains__(self, identifier):
+        return str(identifier) in self.index
+
+    def __len__(self):
+        return len(self.index)
@@ -0,0 +1,81 @@
+"""
+On-disk cache of the preprocessed model inputs, so reruns on the same images (e.g. after a model
+or threshold update) skip the bounds detection, contrast enhancement and cropping.
+
+Entries are keyed by a hash of the pixel data, the preprocessing version and the input size:
+- {key}_{size}.npy: uint8 input (size, size, channels), loaded memory-mapped
+- {key}_{size}.json: bounds of the original image and the cropping transform
+
+Sizes used: 1024 (Processor, 9 channels) and 512 (LandmarksProcessor, 6 channels).
+
+Classes:
+- PreprocessCache
+"""
+
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+
+from .cfi_bounds import CFIBounds
+from .transformation import ProjectiveTransform
+from .utils import get_image_hash
+
+# increase when the bounds detection, contrast enhancement or cropping change,
+# entries of older versions are then not used
+PREPROCESS_VERSION = 1
+
+
+class PreprocessCache:
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def get_key(image, image_hash=None):
+        '''
+        image_hash: optional utils.get_image_hash of image, if computed before (e.g. for the result cache)
+        '''
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f'preprocess_{PREPROCESS_VERSION}'.encode())
+        h.update((image_hash or get_image_hash(image)).encode())
+        return h.hexdigest()
+
+    def path(self, key, size):
+        # subfolders keep the number of files per folder small
+        return f'{self.folder}/{key[:2]}/{key}_{size}'
+
+    def load(self, image, size, key=None):
+        '''
+        Returns:
+        - bounds (CFIBounds of image), T (cropping transform) and the input
+          (memory-mapped copy-on-write array), or None if not cached
+        '''
+        path = self.path(key or self.get_key(image), size)
+        try:
+            with open(f'{path}.json') as f:
+                meta = json.load(f)
+            x = np.load(f'{path}.npy', mmap_mode='c')
+        except (FileNotFoundError, ValueError):
+            return None
+        bounds = CFIBounds.from_dict(image, meta['bounds'])
+        T = ProjectiveTransform.from_dict(meta['transform'])
+        return bounds, T, x
+
+    def save(self, image, size, bounds, T, x, key=None):
+        '''
+        x: uint8 input (size, size, channels)
+        '''
+        path = self.path(key or self.get_key(image), size)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the json is written last, entries without it are ignored
+        # temporary files are unique for each process (e.g. the worker processes) and thread
+        tmp = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(f'{path}.npy{tmp}', 'wb') as f:
+            np.save(f, np.ascontiguousarray(x, dtype=np.uint8))
+        os.replace(f'{path}.npy{tmp}', f'{path}.npy')
+        with open(f'{path}.json{tmp}', 'w') as f:
+            json.dump({'bounds': bounds.to_dict(), 'transform': T.to_dict()}, f)
+        os.replace(f'{path}.json{tmp}', f'{path}.json')
@@ -1,11 +1,11 @@
 import json
 import numpy as np
+import cv2
 from PIL import Image
 import io
 import base64
 
-_style = '''
-<style>
+_css = '''
 table {
     width: 100%;
     border-collapse: collapse;
@@ -58,9 +58,18 @@ div#grid-img-container svg {
     width: 100%;
     height: 100%;
     }
-</style>
 '''
 
+_style = f'<style>{_css}</style>'
+
+
+def export_style(path):
+    '''
+    Writes the report style sheet, to share it between reports (see Report.export)
+    '''
+    with open(path, 'w') as f:
+        f.write(_css)
+
 class NumpyEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.integer):
@@ -72,28 +81,53 @@ class NumpyEncoder(json.JSONEncoder):
         else:
             return super(NumpyEncoder, self).default(obj)
 
-def make_base64(img, size=(256, 256)):
+def make_base64(img, size=(256, 256), format='PNG', **save_kwargs):
     pil_img = Image.fromarray(img)
     if size:
         pil_img.thumbnail(size)
 
     byte_stream = io.BytesIO()
-    pil_img.save(byte_stream, format='PNG')
-    # Encode PNG image to base64 string
+    pil_img.save(byte_stream, format=format, **save_kwargs)
+    # Encode image to base64 string
     img_base64 = base64.b64encode(byte_stream.getvalue()).decode('utf-8')
 
-    return f'data:image/png;base64,{img_base64}'
+    return f'data:image/{format.lower()};base64,{img_base64}'
 
-def make_img(img, size=(384, 384)):
-    return f'<img src="{make_base64(img, size)}"/>'
+def make_img(img, size=(384, 384), format='PNG', **save_kwargs):
+    return f'<img src="{make_base64(img, size, format, **save_kwargs)}"/>'
+
+def make_thumbnail(img, size=(384, 384)):
+    pil_img = Image.fromarray(img)
+    pil_img.thumbnail(size)
+    return np.array(pil_img)
+
+def make_overlay(thumbnail, mask):
+    '''
+    Overlay of a full size binary mask on a thumbnail (mask pixels in white)
+    The mask is downsampled to the fraction of mask pixels in each thumbnail pixel
+    '''
+    h, w = thumbnail.shape[:2]
+    mask = np.asarray(mask, dtype=bool).view(np.uint8)
+    coverage = cv2.resize(mask * np.uint8(255), (w, h), interpolation=cv2.INTER_AREA)
+    coverage = coverage.astype(np.float32) / 255
+    if thumbnail.ndim == 3:
+        coverage = coverage[:, :, None]
+    overlay = thumbnail + (255 - thumbnail.astype(np.float32)) * coverage
+    return np.round(overlay).astype(np.uint8)
 
 class Report:
 
-    def __init__(self, feature_images, etdrs, field_names):
+    def __init__(self, feature_images, etdrs, field_names, summaries=None):
+        '''
+        summaries: previously computed summaries (e.g. from a ResultCache), skips make_summary
+        '''
         self.feature_images = feature_images
         self.etdrs = etdrs
         self.field_names = field_names
-        self.make_summary()
+        if summaries is None:
+            self.make_summary()
+        else:
+            self.summaries = summaries
 
     def make_summary(self):
         self.summaries = {
@@ -101,9 +135,10 @@ class Report:
             for feature_name, img in self.feature_images.items()
         }
 
-    def export(self, folder, image, name, export_html=True, export_json=True):
+    def export(self, folder, image, name, export_html=True, export_json=True,
+               image_format='JPEG', css_href=None):
         if export_html:
-            html = self.generate_html_report(image, name)
+            html = self.generate_html_report(image, name, image_format, css_href)
             with open(f'{folder}/report.html', 'w') as f:
                 f.write(html)
         if export_json:
@@ -141,9 +176,17 @@ class Report:
         ]
         return "\n".join(html)
 
-    def generate_html_report(self, image, name):
-        
-        etdrs_img = make_base64(image)
+    def generate_html_report(self, image, name, image_format='JPEG', css_href=None):
+        '''
+        Args:
+        - image_format: format of the embedded images (PIL format, e.g. 'JPEG', 'WEBP' or 'PNG')
+        - css_href: link to a shared style sheet (see export_style) instead of inlining the style
+        '''
+        # downscale once, all embedded images are made from the thumbnail
+        thumbnail = make_thumbnail(image)
+        save_kwargs = {'quality': 90} if image_format in ('JPEG', 'WEBP') else {}
+
+        etdrs_img = make_base64(thumbnail, format=image_format, **save_kwargs)
         h, w = image.shape[:2]
         base_grid = self.etdrs.create_svg(color='white', crop=False)
         grid_img = f'''
@@ -173,17 +216,21 @@ class Report:
         overlays = {}
 
         for feature_name, img in self.feature_images.items():
-            a = np.copy(image)
-            a[img] = 255
-            overlays[feature_name] = a
+            overlays[feature_name] = make_overlay(thumbnail, img)
         imgs = ''.join(
-            f'<div><h2>{feature_name}</h2>{make_img(img)}</div>' for feature_name, img in overlays.items())
+            f'<div><h2>{feature_name}</h2>{make_img(img, format=image_format, **save_kwargs)}</div>'
+            for feature_name, img in overlays.items())
         imgs = f'<div id="segmentation-container">{imgs}</div>'
 
 
         
+        if css_href is None:
+            style = _style
+        else:
+            style = f'<link rel="stylesheet" href="{css_href}">'
+
         return f'''
-                <!doctype html><html>{_style}
+                <!doctype html><html>{style}
                 <body>
                 <h1>{name} ({self.etdrs.laterality})</h1>
                 <h2>Segmentation output:</h2>
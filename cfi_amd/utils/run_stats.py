@@ -0,0 +1,129 @@
+"""
+Throughput and memory statistics of a run of cfi_amd.main (used by cfi_amd.autotune).
+
+Classes:
+- RunStats
+"""
+
+import time
+
+
+def get_peak_memory():
+    '''
+    Peak resident memory of the current process in bytes, since the last reset_peak_memory on Linux
+    (None if not available, e.g. on Windows)
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_device_peak_memory(device):
+    # peak memory allocated by torch on a cuda device since the last reset (None for other devices)
+    import torch
+    device = torch.device(device)
+    if device.type != 'cuda':
+        return None
+    return torch.cuda.max_memory_allocated(device)
+
+
+def reset_peak_memory(device=None):
+    '''
+    Resets the peak resident memory of the current process (Linux only)
+    and the peak memory of device (cuda only), to measure the peak of one batch
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    if device is not None:
+        import torch
+        if torch.device(device).type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+
+
+class RunStats:
+    '''
+    Completion time of each batch and the peak memory of each process.
+    Throughput is measured from the time each process completed a batch, so model loading is not included.
+    For each batch the peak memory (host and device) and the model batch size are kept (see batch_info).
+    shared_memory: size of the memory shared by all processes (e.g. model weights), counted once in the total
+    '''
+
+    def __init__(self):
+        self.batches = []
+        self.batch_info = []
+        self.peak_memory = {}
+        self.shared_memory = 0
+
+    def add_batch(self, n_images, pid=None, peak_memory=None, device_peak_memory=None, model_batch_size=None):
+        '''
+        pid and peak_memory: process that ran the batch and its peak memory (default: this process)
+        device_peak_memory: peak memory on the device (cuda) during the batch
+        model_batch_size: batch size of the model calls (see utils.adaptive_batch)
+        '''
+        if pid is None:
+            pid = 'main'
+            peak_memory = peak_memory or get_peak_memory()
+        self.batches.append((time.perf_counter(), n_images, pid))
+        self.batch_info.append({
+            'n_images': n_images,
+            'peak_memory': peak_memory,
+            'device_peak_memory': device_peak_memory,
+            'model_batch_size': model_batch_size,
+        })
+        if peak_memory is not None:
+            self.peak_memory[pid] = max(peak_memory, self.peak_memory.get(pid, 0))
+
+    @property
+    def n_images(self):
+        return sum(n for _, n, _ in self.batches)
+
+    @property
+    def images_per_second(self):
+        first = {}
+        for t, _, pid in self.batches:
+            first.setdefault(pid, t)
+        if not first:
+            return None
+        t0 = max(first.values())
+        later = [(t, n) for t, n, _ in self.batches if t > t0]
+        if not later:
+            return None
+        return sum(n for _, n in later) / (later[-1][0] - t0)
+
+    @property
+    def peak_memory_total(self):
+        # sum of the peaks of all processes (an upper bound of the peak of the run)
+        peaks = dict(self.peak_memory)
+        peaks['main'] = max(peaks.get('main', 0), get_peak_memory() or 0)
+        # the shared memory is resident in each process
+        return sum(peaks.values()) - self.shared_memory * (len(peaks) - 1)
+
+    @property
+    def device_peak_memory(self):
+        peaks = [b['device_peak_memory'] for b in self.batch_info if b['device_peak_memory'] is not None]
+        return max(peaks, default=None)
+
+    def to_dict(self, include_batches=False):
+        result = {
+            'n_images': self.n_images,
+            'images_per_second': self.images_per_second,
+            'peak_memory': self.peak_memory_total,
+            'device_peak_memory': self.device_peak_memory,
+            'shared_memory': self.shared_memory,
+        }
+        if include_batches:
+            result['batches'] = self.batch_info
+        return result
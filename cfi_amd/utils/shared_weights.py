@@ -0,0 +1,79 @@
+"""
+Model weights in shared memory, for worker processes on CPU (see cfi_amd.main.run_pool).
+
+The parent process loads the models once and copies their weights to shared memory.
+Passed to a worker process (e.g. in the initargs of a Pool), only a reference to the shared memory
+is sent: the workers attach the weights to their models without copying them, so the resident memory
+of a worker only grows by activations and images.
+
+All weights are stored in one shared tensor per data type (a shared tensor keeps a file descriptor open).
+
+Classes:
+- SharedWeights
+"""
+
+import itertools
+import torch
+
+
+def attach_weights(module, state_dict):
+    '''
+    Replaces the parameters and buffers of module by the tensors of state_dict, without copying.
+    Modules (not TorchScript) can be created on the meta device, so no memory is allocated for their own weights.
+    '''
+    if isinstance(module, torch.jit.ScriptModule):
+        # the storage of the tensors in the script module is swapped
+        for name, t in itertools.chain(module.named_parameters(), module.named_buffers()):
+            t.data = state_dict[name]
+    else:
+        module.load_state_dict(state_dict, assign=True)
+    return module
+
+
+class SharedWeights:
+    '''
+    State dicts of named modules in shared memory, weights[name] returns the state dict of a module
+    (views of the shared tensors)
+    '''
+
+    def __init__(self, modules):
+        '''
+        modules: dict with the modules (on CPU) by name
+        '''
+        state_dicts = {name: module.state_dict() for name, module in modules.items()}
+        tensors = [t for state_dict in state_dicts.values() for t in state_dict.values()]
+        self.buffers = {
+            dtype: torch.empty(sum(t.numel() for t in tensors if t.dtype == dtype), dtype=dtype).share_memory_()
+            for dtype in {t.dtype for t in tensors}
+        }
+
+        # name -> list of (key, dtype, offset, shape)
+        self.layout = {}
+        offsets = dict.fromkeys(self.buffers, 0)
+        for name, state_dict in state_dicts.items():
+            self.layout[name] = []
+            for key, t in state_dict.items():
+                offset = offsets[t.dtype]
+                self.buffers[t.dtype][offset:offset + t.numel()].view(t.shape).copy_(t)
+                self.layout[name].append((key, t.dtype, offset, tuple(t.shape)))
+                offsets[t.dtype] += t.numel()
+
+    @property
+    def nbytes(self):
+        return sum(b.numel() * b.element_size() for b in self.buffers.values())
+
+    def __contains__(self, name):
+        return name in self.layout
+
+    def __getitem__(self, name):
+        state_dict = {}
+        for key, dtype, offset, shape in self.layout[name]:
+            numel = 1
+            for s in shape:
+                numel *= s
+            state_dict[key] = self.buffers[dtype][offset:offset + numel].view(shape)
+        return state_dict
+
+    def attach(self, name, module):
+        # see attach_weights
+        return attach_weights(module, self[name])
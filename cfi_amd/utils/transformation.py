@@ -92,6 +92,25 @@ class ProjectiveTransform:
         return ProjectiveTransform(np.array(d["M"]), d["in_size"], d["out_size"])
 
 
+def apply_inverse_batch(transforms, points):
+    '''
+    ProjectiveTransform.apply_inverse for a batch of transforms in one step
+
+    Args:
+    - transforms: list of N ProjectiveTransforms
+    - points: array (N, K, 2), K points for each transform
+
+    Returns:
+    - array (N, K, 2)
+    '''
+    points = np.asarray(points, dtype=float)
+    M_inv = np.stack([T.M_inv for T in transforms])
+    points_homogeneous = np.concatenate(
+        [points, np.ones(points.shape[:-1] + (1,))], axis=-1)
+    p = np.einsum('nkj,nij->nki', points_homogeneous, M_inv)
+    return p[..., :2] / p[..., [-1]]
+
+
 def get_affine_transform(in_size, out_size, rotate=0, scale=1, center=None, flip=(False, False)):
     """
     Parameters:
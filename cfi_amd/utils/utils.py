@@ -1,5 +1,5 @@
+import hashlib
 import numpy as np
-import pydicom
 from PIL import Image
 
 from .transformation import get_affine_transform
@@ -9,6 +9,7 @@ def open_image_from_path(path):
     try:
         return np.array(Image.open(path))
     except:
+        import pydicom
         return pydicom.dcmread(path, force=True).pixel_array
 
 def open_image(filename):
@@ -28,6 +29,17 @@ def get_gray_scale(array):
         raise ValueError("Unknown image format")
 
 
+def get_image_hash(image):
+    '''
+    Hash of the pixel data (with shape and dtype), computed once per image for the caches
+    (see utils.preprocess_cache and result_cache)
+    '''
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f'{image.shape}{image.dtype}'.encode())
+    h.update(np.ascontiguousarray(image).data)
+    return h.hexdigest()
+
+
 def rescale(image, resolution=1024):
     """
     Rescale image to resolution x resolution
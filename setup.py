@@ -5,7 +5,7 @@ setup(
     version="0.1.0",
     packages=find_packages(),
     install_requires=[
-        "lightning==2.4.0",
+        "torch>=2.1",
         "opencv-python-headless==4.10.0.84",
         "scipy==1.14.1",
         "scikit-learn==1.5.2",